@@ -17,19 +17,29 @@ V1.0.4 by Andreas Schminder
 - Added Solo Cloudwatcher
 '''
 import allsky_shared as s
+import os
 import time
 import sys
 import json
-import urllib.request
+import csv
+import bisect
+import struct
+import math
+import numpy as np
+import threading
+import statistics
+import concurrent.futures
+import calendar
+import tempfile
+import requests
+from collections import namedtuple
 import board
 import adafruit_sht31d
 import adafruit_dht
 import adafruit_ahtx0
 from adafruit_bme280 import basic as adafruit_bme280
 from adafruit_htu21d import HTU21D
-from meteocalc import heat_index
-from meteocalc import dew_point
-from digitalio import DigitalInOut, Direction, Pull
+from digitalio import DigitalInOut
     
 metaData = {
     "name": "Sky Dew Heater Control",
@@ -57,7 +67,23 @@ metaData = {
         "dhtxxdelay" : "500",
         "extradatafilename": "allskydew.json",
         "sht31heater": "False",
-        "solourl": ""
+        "solourl": "",
+        "sampling": "0",
+        "staleness": "60",
+        "pinrefresh": "300",
+        "solotimeout": "5",
+        "solocache": "10",
+        "extrasensors": "",
+        "fusion": "Median",
+        "deadline": "0",
+        "control": "Threshold",
+        "lookahead": "900",
+        "hysteresis": "1",
+        "maxdelay": "600",
+        "replayfile": "",
+        "historyfile": "dewheater_history.bin",
+        "dutywindow": "3600",
+        "heaterwatts": "0"
     },
     "argumentdetails": {
         "type" : {
@@ -67,7 +93,7 @@ metaData = {
             "tab": "Sensor",
             "type": {
                 "fieldtype": "select",
-                "values": "None,SHT31,DHT22,DHT11,AM2302,BME280-I2C,HTU21,AHTx0,SOLO-Cloudwatcher",
+                "values": "None,SHT31,DHT22,DHT11,AM2302,BME280-I2C,HTU21,AHTx0,SOLO-Cloudwatcher,Replay",
                 "default": "None"
             }
         },
@@ -86,6 +112,65 @@ metaData = {
             "help": "Override the standard i2c address for a device. NOTE: This value must be hex i.e. 0x76",
             "tab": "Sensor"
         },
+        "replayfile": {
+            "required": "false",
+            "description": "Replay File",
+            "help": "Replay sensor type only. CSV or NumPy file of time, temperature, humidity and optional pressure readings to replay instead of a sensor, for testing the heater control",
+            "tab": "Sensor"
+        },
+        "extrasensors": {
+            "required": "false",
+            "description": "Extra Sensors",
+            "help": "Comma separated list of extra sensor types that are read together with the main sensor, i.e. SOLO-Cloudwatcher,BME280-I2C. An i2c address can follow the type after a colon, i.e. BME280-I2C:0x77. The other sensor settings are shared",
+            "tab": "Sensor"
+        },
+        "fusion" : {
+            "required": "false",
+            "description": "Combine Readings",
+            "help": "How the readings of several sensors are combined. Median uses the median of all the readings, Priority the first sensor that could be read, the main sensor first",
+            "tab": "Sensor",
+            "type": {
+                "fieldtype": "select",
+                "values": "Median,Priority",
+                "default": "Median"
+            }
+        },
+        "deadline" : {
+            "required": "false",
+            "description": "Read Deadline",
+            "help": "The sensors are read at the same time and only the readings that arrive within this many seconds are used. A slow sensor is skipped, its reading is only used on a later run if the module stays loaded between runs in a long running process. Zero will wait for all the sensors",
+            "tab": "Sensor",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 120,
+                "step": 1
+            }
+        },
+        "sampling" : {
+            "required": "false",
+            "description": "Sampling Interval",
+            "help": "Read the sensor in the background every this many seconds, so a slow sensor does not hold up the periodic jobs. This only helps when the module stays loaded between runs in a long running process, the sampler is started on the second run in the same process and a module started for every run always reads the sensor when the heater is checked. Zero will disable this and read the sensor when the heater is checked",
+            "tab": "Sensor",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 600,
+                "step": 1
+            }
+        },
+        "staleness" : {
+            "required": "false",
+            "description": "Max Sample Age",
+            "help": "A reading older than this many seconds counts as a failed read, for background sampling and when the last Solo readings have to be used because the Solo can not be reached. Zero will disable this",
+            "tab": "Sensor",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 3600,
+                "step": 1
+            }
+        },
         "dhtxxretrycount" : {
             "required": "false",
             "description": "Retry Count",
@@ -128,6 +213,48 @@ metaData = {
                 "fieldtype": "gpio"
             }
         },
+        "pinrefresh" : {
+            "required": "false",
+            "description": "Pin Refresh",
+            "help": "The heater and extra pins are only written when the heater is switched. For safety they are written again every this many seconds, zero will disable this",
+            "tab": "Heater",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 86400,
+                "step": 1
+            }
+        },
+        "historyfile": {
+            "required": "false",
+            "description": "History File",
+            "help": "Every switch of the heater is recorded in this binary file in the allsky tmp folder, or at this path if it is a full path, for the duty cycle and energy variables. Leave empty to disable this",
+            "tab": "Heater"
+        },
+        "dutywindow" : {
+            "required": "false",
+            "description": "Duty Cycle Window",
+            "help": "The duty cycle is the percentage of time the heater was on over this many seconds",
+            "tab": "Heater",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 60,
+                "max": 86400,
+                "step": 60
+            }
+        },
+        "heaterwatts" : {
+            "required": "false",
+            "description": "Heater Power",
+            "help": "The power of the heater in watts, used to estimate the energy it used today. Zero will disable this",
+            "tab": "Heater",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 1000,
+                "step": 1
+            }
+        },
         "heaterstartupstate" : {
             "required": "false",
             "description": "heater Startup State",
@@ -181,6 +308,53 @@ metaData = {
                 "step": 1
             }
         },
+        "control" : {
+            "required": "false",
+            "description": "Control",
+            "help": "Threshold switches the heater on whenever the temperature is within the limit of the dew point. Predictive follows the trend of the dew point and switches the heater on before it gets within the limit, with hysteresis, and reads the sensor less often while dew is far off",
+            "tab": "Dew Control",
+            "type": {
+                "fieldtype": "select",
+                "values": "Threshold,Predictive",
+                "default": "Threshold"
+            }
+        },
+        "lookahead" : {
+            "required": "false",
+            "description": "Look Ahead",
+            "help": "Predictive only, the heater is switched on if the temperature is predicted to get within the limit of the dew point in this many seconds",
+            "tab": "Dew Control",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 7200,
+                "step": 60
+            }
+        },
+        "hysteresis" : {
+            "required": "false",
+            "description": "Hysteresis",
+            "help": "Predictive only, the heater is only switched off once the temperature is this many degrees further from the dew point than the limit",
+            "tab": "Dew Control",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 10,
+                "step": 0.1
+            }
+        },
+        "maxdelay" : {
+            "required": "false",
+            "description": "Max Delay",
+            "help": "Predictive only, while the heater is off and dew is far off the delay between sensor reads is stretched up to this many seconds",
+            "tab": "Dew Control",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 3600,
+                "step": 1
+            }
+        },
         "force" : {
             "required": "false",
             "description": "Forced Temperature",
@@ -225,7 +399,31 @@ metaData = {
             "description": "URL from solo",
             "help": "Read weather data from lunaticoastro.com 'Solo Cloudwatcher'",
             "tab": "Solo"
-        }        
+        },
+        "solotimeout" : {
+            "required": "false",
+            "description": "Timeout",
+            "help": "The time in seconds to wait for the Solo to answer",
+            "tab": "Solo",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 1,
+                "max": 60,
+                "step": 1
+            }
+        },
+        "solocache" : {
+            "required": "false",
+            "description": "Cache Time",
+            "help": "The Solo readings are reused for this many seconds before the Solo is asked again, zero will disable this",
+            "tab": "Solo",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 600,
+                "step": 1
+            }
+        }
     },
     "changelog": {
         "v1.0.0" : [
@@ -270,50 +468,94 @@ metaData = {
     }
 }
 
-def readSHT31(sht31heater):
-    temperature = None
-    humidity = None
-    try:
-        i2c = board.I2C()
-        sensor = adafruit_sht31d.SHT31D(i2c)
-        sensor.heater = sht31heater
-        temperature = sensor.temperature
-        humidity = sensor.relative_humidity
-    except RuntimeError as e:
-        eType, eObject, eTraceback = sys.exc_info()
-        s.log(4, f"ERROR: Module readSHT31 failed on line {eTraceback.tb_lineno} - {e}")
+sensorSample = namedtuple("sensorSample", ["timestamp", "temperature", "humidity", "pressure", "relHumidity", "altitude", "dewPoint"], \
+    defaults=[None, None, None, None, None, None])
 
-    return temperature, humidity
+I2C_SENSORS = ["SHT31", "BME280-I2C", "HTU21", "AHTx0"]
+DHT_SENSORS = ["DHT22", "DHT11", "AM2302"]
 
-def doDHTXXRead(inputpin):
-    temperature = None
-    humidity = None
+class sensorRegistry():
+    '''
+    Keeps one initialised driver per (sensor type, bus, address) for the life of the process so
+    the bus probing and calibration reads, i.e. the BME280 compensation coefficients, are only
+    done once. A driver is only created again after an I/O error.
+    '''
+
+    def __init__(self):
+        self.drivers = {}
+
+    def _key(self, sensorType, inputpin, i2caddress):
+        if sensorType in DHT_SENSORS:
+            return (sensorType, "gpio", inputpin)
+
+        address = None
+        if i2caddress != "":
+            address = int(i2caddress, 16)
+
+        return (sensorType, "i2c", address)
+
+    def _create(self, sensorType, bus, address):
+        if bus == "gpio":
+            return adafruit_dht.DHT22(s.getGPIOPin(address), use_pulseio=False)
+
+        args = [board.I2C()]
+        if address is not None:
+            args.append(address)
+        if sensorType == "SHT31":
+            return adafruit_sht31d.SHT31D(*args)
+        if sensorType == "BME280-I2C":
+            return adafruit_bme280.Adafruit_BME280_I2C(*args)
+        if sensorType == "HTU21":
+            return HTU21D(*args)
+
+        return adafruit_ahtx0.AHTx0(*args)
+
+    def read(self, sensorType, inputpin=0, i2caddress="", sht31heater=False):
+        '''
+        Reads the sensor and returns a sensorSample, the values are None if the read failed
+        '''
+        try:
+            key = self._key(sensorType, inputpin, i2caddress)
+        except ValueError:
+            s.log(0, "ERROR: Address {} is not a valid i2c address".format(i2caddress))
+            return sensorSample(time.time())
 
-    try:
-        pin = s.getGPIOPin(inputpin)
-        dhtDevice = adafruit_dht.DHT22(pin, use_pulseio=False)
         try:
-            temperature = dhtDevice.temperature
-            humidity = dhtDevice.humidity
-        except RuntimeError as e:
+            if key not in self.drivers:
+                self.drivers[key] = self._create(*key)
+            sensor = self.drivers[key]
+
+            if sensorType == "SHT31":
+                sensor.heater = sht31heater
+            temperature = sensor.temperature
+            if sensorType in DHT_SENSORS:
+                humidity = sensor.humidity
+            else:
+                humidity = sensor.relative_humidity
+            if sensorType == "BME280-I2C":
+                return sensorSample(time.time(), temperature, humidity, sensor.pressure, humidity, sensor.altitude)
+
+            return sensorSample(time.time(), temperature, humidity)
+        except OSError as e:
+            self.drivers.pop(key, None)
+            eType, eObject, eTraceback = sys.exc_info()
+            s.log(4, f"ERROR: Module sensorRegistry.read {sensorType} I/O error on line {eTraceback.tb_lineno}, the driver will be recreated - {e}")
+        except (RuntimeError, ValueError) as e:
             eType, eObject, eTraceback = sys.exc_info()
-            s.log(4, f"ERROR: Module doDHTXXRead failed on line {eTraceback.tb_lineno} - {e}")
-    except Exception as e:
-        eType, eObject, eTraceback = sys.exc_info()
-        s.log(4, f"ERROR: Module doDHTXXRead failed on line {eTraceback.tb_lineno} - {e}")
+            s.log(4, f"ERROR: Module sensorRegistry.read {sensorType} failed on line {eTraceback.tb_lineno} - {e}")
 
-    return temperature, humidity
+        return sensorSample(time.time())
+
+sensors = sensorRegistry()
 
 def readDHT22(inputpin, dhtxxretrycount, dhtxxdelay):
-    temperature = None
-    humidity = None
     count = 0
     reading = True
 
     while reading:
-        temperature, humidity = doDHTXXRead(inputpin)
+        sample = sensors.read("DHT22", inputpin)
 
-        if temperature is None and humidity is None:
+        if sample.temperature is None and sample.humidity is None:
             s.log(4, "INFO: Failed to read DHTXX on attempt {}".format(count+1))
             count = count + 1
             if count > dhtxxretrycount:
@@ -323,207 +565,771 @@ def readDHT22(inputpin, dhtxxretrycount, dhtxxdelay):
         else:
             reading = False
 
-    return temperature, humidity
+    return sample
+
+class soloClient():
+    '''
+    Reads the SOLO Cloudwatcher LastReadings with connect and read timeouts, so an unreachable
+    SOLO can not hang the periodic jobs, over one keep-alive HTTP session while the process lives.
+    The last good readings are kept in a small file in the allsky tmp folder with their
+    dataGMTTime and the time they were fetched, as allsky usually starts the module in a new
+    process for every run. They are used for cache seconds before the SOLO is asked again, and
+    a response is only parsed when it changed. Readings fetched from the SOLO are timestamped
+    with the time they were fetched. When the SOLO can not be read the last readings are
+    returned timestamped with their dataGMTTime instead, so they carry their real age.
+    '''
+
+    connectTimeout = 3.05
+    cacheFile = "dewheater_solo.json"
+
+    def __init__(self):
+        self.session = None
+        self.url = None
+        self.fetched = 0
+        self.body = None
+        self.dataTime = None
+        self.sample = None
+
+    def _timestamp(self, gmtTime, now):
+        try:
+            return min(calendar.timegm(time.strptime(gmtTime, "%Y/%m/%d %H:%M:%S")), now)
+        except ValueError:
+            return now
+
+    def _fileName(self):
+        tmpPath = s.getEnvironmentVariable("ALLSKY_TMP")
+        if tmpPath is None:
+            return None
+
+        return os.path.join(tmpPath, self.cacheFile)
+
+    def _load(self):
+        fileName = self._fileName()
+        if fileName is None or not os.path.exists(fileName):
+            return
+
+        try:
+            with open(fileName) as file:
+                saved = json.load(file)
+            if saved["url"] == self.url:
+                self.sample = sensorSample(*saved["sample"])
+                self.fetched = float(saved["fetched"])
+                self.dataTime = float(saved["dataTime"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            s.log(4, f"ERROR: Module readSolo ignoring unreadable {fileName} - {e}")
 
-def readBme280I2C(i2caddress):
-    temperature = None
-    humidity = None
-    pressure = None
-    relHumidity = None
-    altitude = None
+    def _save(self):
+        fileName = self._fileName()
+        if fileName is None:
+            return
 
-    if i2caddress != "":
+        saved = {"url": self.url, "fetched": self.fetched, "dataTime": self.dataTime, "sample": list(self.sample)}
+        tmpFile = None
         try:
-            i2caddressInt = int(i2caddress, 16)
+            handle, tmpFile = tempfile.mkstemp(dir=os.path.dirname(fileName), suffix=".tmp")
+            with os.fdopen(handle, "w") as file:
+                json.dump(saved, file)
+            os.replace(tmpFile, fileName)
+        except OSError as e:
+            s.log(4, f"ERROR: Module readSolo unable to write {fileName} - {e}")
+            if tmpFile is not None and os.path.exists(tmpFile):
+                os.remove(tmpFile)
+
+    def read(self, url, timeout, cache):
+        now = time.time()
+        if url != self.url:
+            self.url = url
+            self.fetched = 0
+            self.body = self.dataTime = self.sample = None
+            self._load()
+        if self.sample is not None and 0 <= now - self.fetched < cache:
+            return self.sample._replace(timestamp=self.fetched)
+
+        try:
+            if self.session is None:
+                self.session = requests.Session()
+            #Read Weaterdata from SOLO Website
+            response = self.session.get(url, timeout=(self.connectTimeout, timeout))
+            response.raise_for_status()
+            if response.content != self.body or self.sample is None:
+                currentWeatherdata = json.loads(response.content)['LastReadings']
+
+                # that is what you should receive
+                #    { "LastReadings": {
+                #    "dataGMTTime" : "2023/12/17 22:52:40",
+                #    "cwinfo" : "Serial: 2550, FW: 5.89",
+                #    "clouds" : -14.850000,
+                #    "cloudsSafe" : "Unsafe",
+                #    "temp" : 8.450000,
+                #    "wind" : 12,
+                #    "windSafe" : "Safe",
+                #    "gust" : 13,
+                #    "rain" : 3072,
+                #    "rainSafe" : "Safe",
+                #    "lightmpsas" : 20.31,
+                #    "lightSafe" : "Safe",
+                #    "switch" : 0,
+                #    "safe" : 0,
+                #    "hum" : 65,
+                #    "humSafe" : "Safe",
+                #    "dewp" : 2.250000,
+                #    "rawir" : -19.150000,
+                #    "abspress" : 1003.600000,
+                #    "relpress" : 1032.722598,
+                #    "pressureSafe" : "Safe"
+                #    }
+                #    }
+
+                # the readings are only taken once all of them parsed
+                sample = sensorSample(now, float(currentWeatherdata['temp']), float(currentWeatherdata['hum']), \
+                    float(currentWeatherdata['relpress']), dewPoint=float(currentWeatherdata['dewp']))
+                self.dataTime = self._timestamp(currentWeatherdata['dataGMTTime'], now)
+                self.sample = sample
+                self.body = response.content
+            self.fetched = now
+            self._save()
+            return self.sample._replace(timestamp=now)
         except Exception as e:
             eType, eObject, eTraceback = sys.exc_info()
-            s.log(0, f"ERROR: Module readBme280I2C failed on line {eTraceback.tb_lineno} - {e}")
+            s.log(4, f"ERROR: Module readSolo failed on line {eTraceback.tb_lineno} - {e}")
 
-    try:
-        i2c = board.I2C()
-        if i2caddress != "":
-            bme280 = adafruit_bme280.Adafruit_BME280_I2C(i2c, i2caddressInt)
-        else:
-            bme280 = adafruit_bme280.Adafruit_BME280_I2C(i2c)
+        if self.sample is None:
+            return sensorSample(now)
 
-        temperature =  bme280.temperature
-        humidity = bme280.relative_humidity
-        relHumidity = bme280.relative_humidity
-        altitude = bme280.altitude
-        pressure = bme280.pressure
-    except ValueError as e:
-        eType, eObject, eTraceback = sys.exc_info()
-        s.log(0, f"ERROR: Module readBme280I2C failed on line {eTraceback.tb_lineno} - {e}")
+        s.log(1, "INFO: Using the SOLO readings from {:.0f}s ago".format(now - self.dataTime))
+        return self.sample._replace(timestamp=self.dataTime)
 
-    return temperature, humidity, pressure, relHumidity, altitude
+solo = soloClient()
 
-def readHtu21(i2caddress):
-    temperature = None
-    humidity = None
+def readSolo(url, timeout=5, cache=0):
+    return solo.read(url, timeout, cache)
 
-    if i2caddress != "":
-        try:
-            i2caddressInt = int(i2caddress, 16)
-        except:
-            result = "Address {} is not a valid i2c address".format(i2caddress)
-            s.log(0,"ERROR: {}".format(result))
+class pinCache():
+    '''
+    Writes the relay pins only when their state really changes. The value last written to each
+    pin and when are kept in the heater state, under "pins", so this also holds when allsky
+    starts the module in a new process for every run. Every refresh seconds the value is written
+    again anyway in case something else changed the pin, zero disables this. Values written
+    before the last boot are ignored as the pins are reset then. The DigitalInOut of each pin is
+    kept for as long as the process lives.
+    '''
 
-    try:
-        i2c = board.I2C()
-        if i2caddress != "":
-            htu21 = HTU21D(i2c, i2caddressInt)
+    def __init__(self):
+        self.pins = {}
+        self.written = {}
+        self.refresh = 0
+        self.bootTime = None
+
+    def _boot(self):
+        if self.bootTime is None:
+            self.bootTime = 0
+            try:
+                with open("/proc/stat") as file:
+                    for line in file:
+                        if line.startswith("btime "):
+                            self.bootTime = int(line.split()[1])
+            except (OSError, ValueError):
+                pass
+
+        return self.bootTime
+
+    def write(self, pin, value, state=None):
+        '''
+        Sets the pin to value and returns True if that changed its state
+        '''
+        now = int(time.time())
+        key = str(pin)
+        written = self.written if state is None else state.get("pins", {})
+        lastValue, lastWrite = written.get(key, [None, 0])
+        if lastWrite < self._boot():
+            lastValue = None
+
+        changed = lastValue != value
+        if changed or (self.refresh != 0 and now - lastWrite >= self.refresh):
+            if key in self.pins:
+                self.pins[key].value = value
+            else:
+                self.pins[key] = DigitalInOut(pin)
+                self.pins[key].switch_to_output(value=value)
+            written = dict(written)
+            written[key] = [value, now]
+            if state is None:
+                self.written = written
+            else:
+                state.set("pins", written)
+
+        return changed
+
+pins = pinCache()
+
+class heaterState():
+    '''
+    The dew heater state kept in the allsky database, the time of the last run, the time the
+    heater was switched on and the values last written to the relay pins. It is all stored under one key that is read once when the module
+    runs, changed in memory and written back with a single update by flush(), so the database
+    never holds the last run of one run with the on time of another. The separate keys used by
+    older versions are migrated and only removed once the new key is written.
+    '''
+
+    stateKey = "dewheaterstate"
+    legacyKeys = {
+        "lastrun": "dewheaterlastrun",
+        "ontime": "dewheaterontime"
+    }
+
+    def __init__(self):
+        self.values = {}
+        self.legacy = []
+        self.exists = s.dbHasKey(self.stateKey)
+        if self.exists:
+            self.values = dict(s.dbGet(self.stateKey))
         else:
-            htu21 = HTU21D(i2c)
+            for name, key in self.legacyKeys.items():
+                if s.dbHasKey(key):
+                    self.values[name] = s.dbGet(key)
+                    self.legacy.append(key)
+        self.changed = len(self.legacy) > 0
 
-        temperature =  htu21.temperature
-        humidity = htu21.relative_humidity
-    except ValueError as e:
-        eType, eObject, eTraceback = sys.exc_info()
-        s.log(4, f"ERROR: Module readHtu21 failed on line {eTraceback.tb_lineno} - {e}")
-        
-    return temperature, humidity
+    def get(self, name, default=None):
+        return self.values.get(name, default)
 
-def readAHTX0(i2caddress):
-    temperature = None
-    humidity = None
+    def set(self, name, value):
+        if self.values.get(name) != value:
+            self.values[name] = value
+            self.changed = True
 
-    if i2caddress != "":
-        try:
-            i2caddressInt = int(i2caddress, 16)
-        except:
-            result = "Address {} is not a valid i2c address".format(i2caddress)
-            s.log(0,"ERROR: {}".format(result))
+    def delete(self, name):
+        if name in self.values:
+            del self.values[name]
+            self.changed = True
 
-    try:
-        i2c = board.I2C()
-        sensor = adafruit_ahtx0.AHTx0(i2c)
-        temperature = sensor.temperature
-        humidity = sensor.relative_humidity
-    except ValueError as e:
-        eType, eObject, eTraceback = sys.exc_info()
-        s.log(4, f"ERROR: Module readAHTX0 failed on line {eTraceback.tb_lineno} - {e}")
-
-    return temperature, humidity
-
-def readSolo(url):
-    temperature = None
-    humidity = None
-    pressure = None
-    dewPoint = None
-    
-    try: 
-        #Read Weaterdata from SOLO Website
-        jsonData = urllib.request.urlopen(url).read()  
-        currentWeatherdata =  json.loads(jsonData)['LastReadings']
-
-        # that is what you should receive
-        #    { "LastReadings": {
-        #    "dataGMTTime" : "2023/12/17 22:52:40",
-        #    "cwinfo" : "Serial: 2550, FW: 5.89",
-        #    "clouds" : -14.850000,
-        #    "cloudsSafe" : "Unsafe",
-        #    "temp" : 8.450000,
-        #    "wind" : 12,
-        #    "windSafe" : "Safe",
-        #    "gust" : 13,
-        #    "rain" : 3072,
-        #    "rainSafe" : "Safe",
-        #    "lightmpsas" : 20.31,
-        #    "lightSafe" : "Safe",
-        #    "switch" : 0,
-        #    "safe" : 0,
-        #    "hum" : 65,
-        #    "humSafe" : "Safe",
-        #    "dewp" : 2.250000,
-        #    "rawir" : -19.150000,
-        #    "abspress" : 1003.600000,
-        #    "relpress" : 1032.722598,
-        #    "pressureSafe" : "Safe"
-        #    }
-        #    }        
-            
-        temperature = float(currentWeatherdata['temp'])
-        humidity = float(currentWeatherdata['hum'])
-        pressure = float(currentWeatherdata['relpress'])
-        dewPoint = float(currentWeatherdata['dewp'])
-    except Exception as e:
-        eType, eObject, eTraceback = sys.exc_info()
-        s.log(4, f"ERROR: Module readSolo failed on line {eTraceback.tb_lineno} - {e}")
-            
-    return temperature, humidity, pressure, dewPoint
-
-def turnHeaterOn(heaterpin, invertrelay, extra=False):
+    def flush(self):
+        if self.changed:
+            if self.exists:
+                s.dbUpdate(self.stateKey, dict(self.values))
+            else:
+                s.dbAdd(self.stateKey, dict(self.values))
+                self.exists = True
+            self.changed = False
+
+        for key in self.legacy:
+            s.dbDeleteKey(key)
+        self.legacy = []
+
+def turnHeaterOn(heaterpin, invertrelay, extra=False, state=None):
     if extra:
         type = 'Extra'
     else:
         type = 'Heater'
         
-    result = f"Turning {type} on using pin {heaterpin}"
-    pin = DigitalInOut(heaterpin)
-    pin.switch_to_output()
-    
     if invertrelay:
-        pin.value = 0
+        changed = pins.write(heaterpin, 0, state)
     else:
-        pin.value = 1
+        changed = pins.write(heaterpin, 1, state)
 
-    if not s.dbHasKey("dewheaterontime"):
-        now = int(time.time())
-        s.dbAdd("dewheaterontime", now)
-    s.log(1,f"INFO: {result}")
+    if changed:
+        if state is not None and not extra and state.get("ontime") is None:
+            state.set("ontime", int(time.time()))
+        s.log(1,f"INFO: Turning {type} on using pin {heaterpin}")
+    else:
+        s.log(4,f"INFO: {type} already on using pin {heaterpin}")
 
-def turnHeaterOff(heaterpin, invertrelay, extra=False):
+def turnHeaterOff(heaterpin, invertrelay, extra=False, state=None):
     if extra:
         type = 'Extra'
     else:
         type = 'Heater'
                     
-    result = f"Turning {type} off using pin {heaterpin}"
-    pin = DigitalInOut(heaterpin)
-    pin.direction = Direction.OUTPUT
-    
     if invertrelay:
-        pin.value = 1
+        changed = pins.write(heaterpin, 1, state)
     else:
-        pin.value = 0
+        changed = pins.write(heaterpin, 0, state)
         
-    if s.dbHasKey("dewheaterontime"):
-        s.dbDeleteKey("dewheaterontime")
-    s.log(1,f"INFO: {result}")
-
-def getSensorReading(sensorType, inputpin, i2caddress, dhtxxretrycount, dhtxxdelay, sht31heater, soloURL):
-    temperature = None
-    humidity = None
-    dewPoint = None
-    heatIndex = None
-    pressure = None
-    relHumidity = None
-    altitude = None
-
-    if sensorType == "SHT31":
-        temperature, humidity = readSHT31(sht31heater)
-    elif sensorType == "DHT22" or sensorType == "DHT11" or sensorType == "AM2302":
-        temperature, humidity = readDHT22(inputpin, dhtxxretrycount, dhtxxdelay)
-    elif sensorType == "BME280-I2C":
-        temperature, humidity, pressure, relHumidity, altitude = readBme280I2C(i2caddress)
-    elif sensorType == "HTU21":
-        temperature, humidity = readHtu21(i2caddress)
-    elif sensorType == "AHTx0":
-        temperature, humidity = readAHTX0(i2caddress)
+    if changed:
+        if state is not None and not extra:
+            state.delete("ontime")
+        s.log(1,f"INFO: Turning {type} off using pin {heaterpin}")
+    else:
+        s.log(4,f"INFO: {type} already off using pin {heaterpin}")
+
+class heaterHistory():
+    '''
+    Every heater switch is appended to a binary file as a fixed size record of the time, on or
+    off, the ambient temperature and the dew point. The duty cycle and the on time are worked out
+    from cursors kept in the heater state, one for the end of the history, one for the start of
+    the rolling window and one for midnight. Each cursor holds the record it is on with the on
+    time up to that record and only ever moves forward, so a run reads just the records added or
+    passed since the last one whatever the length of the history. If the file is replaced or
+    the state lost the cursors start again from the first record.
+    '''
+
+    record = struct.Struct("<dBff")
+    start = [-1, 0, 0, 0]
+
+    def __init__(self):
+        self.fileName = None
+        self.file = None
+
+    def _open(self, fileName):
+        if fileName != self.fileName or self.file is None or self.file.closed:
+            if self.file is not None:
+                self.file.close()
+            self.fileName = fileName
+            self.file = open(fileName, "a+b")
+
+    def _read(self, index):
+        self.file.seek(index * self.record.size)
+        data = self.file.read(self.record.size)
+        if len(data) < self.record.size:
+            return None
+        return self.record.unpack(data)
+
+    def _advance(self, cursor, target):
+        '''
+        Moves the cursor to the last record at or before target and returns the on time up to target
+        '''
+        if cursor[0] >= 0 and cursor[1] > target:
+            cursor[:] = self.start
+        index, timestamp, heaterOn, onTime = cursor
+        while True:
+            entry = self._read(index + 1)
+            if entry is None or entry[0] > target:
+                break
+            if index >= 0:
+                onTime = onTime + heaterOn * (entry[0] - timestamp)
+            index, timestamp, heaterOn = index + 1, entry[0], entry[1]
+        cursor[:] = [index, timestamp, heaterOn, onTime]
+
+        if index < 0:
+            return 0
+        return onTime + heaterOn * max(target - timestamp, 0)
+
+    def _cursors(self, state):
+        cursors = state.get("energy")
+        size = os.fstat(self.file.fileno()).st_size // self.record.size
+        if cursors is None or any(cursor[0] >= size for cursor in cursors.values()):
+            cursors = {name: list(self.start) for name in ("end", "window", "day")}
+        else:
+            cursors = {name: list(cursor) for name, cursor in cursors.items()}
+
+        return cursors
+
+    def update(self, fileName, state, now, heaterOn, temperature, dewPoint, window):
+        '''
+        Appends a record if the heater was switched and returns the duty cycle in percent over the
+        last window seconds, or since the first record if that is later, and the seconds the heater
+        was on today
+        '''
+        self._open(fileName)
+        cursors = self._cursors(state)
+
+        self._advance(cursors["end"], now)
+        if cursors["end"][0] < 0 or bool(cursors["end"][2]) != heaterOn:
+            self.file.seek(0, os.SEEK_END)
+            self.file.write(self.record.pack(now, int(heaterOn), temperature, dewPoint))
+            self.file.flush()
+        onTime = self._advance(cursors["end"], now)
+
+        first = self._read(0)[0]
+        windowStart = max(now - window, first)
+        duty = 0
+        if now > windowStart:
+            duty = 100.0 * (onTime - self._advance(cursors["window"], windowStart)) / (now - windowStart)
+
+        midnight = time.mktime(time.localtime(now)[:3] + (0, 0, 0, 0, 0, -1))
+        onToday = onTime - self._advance(cursors["day"], midnight)
+
+        state.set("energy", cursors)
+
+        return duty, onToday
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+history = heaterHistory()
+
+def updateHistory(historyFile, state, now, heater, temperature=math.nan, dewPoint=math.nan, window=3600):
+    if historyFile == "":
+        return None
+
+    if not os.path.isabs(historyFile):
+        tmpPath = s.getEnvironmentVariable("ALLSKY_TMP")
+        if tmpPath is None:
+            return None
+        historyFile = os.path.join(tmpPath, historyFile)
+
+    try:
+        return history.update(historyFile, state, now, heater == 'On', temperature, dewPoint, window)
+    except (OSError, struct.error) as e:
+        history.close()
+        s.log(0, "ERROR: Unable to update heater history {}. {}".format(historyFile, e))
+        return None
+
+class replaySensor():
+    '''
+    Replays recorded or synthetic readings so the heater control can be tried without a sensor.
+    The file is a CSV, or a NumPy .npy or .npz array, with one row per reading of time,
+    temperature, humidity and optionally pressure. Times below 1e9 are seconds from the first
+    read, larger ones unix timestamps. Every read returns the last row at or before the current
+    time, after the end of the trace the reads fail. The time of the first read is kept in a small
+    file in the allsky tmp folder with the name and modification time of the trace, as allsky
+    usually starts the module in a new process for every run, and the replay starts again when
+    the trace changes.
+    '''
+
+    anchorFile = "dewheater_replay.json"
+
+    def __init__(self):
+        self.fileName = None
+        self.modified = None
+        self.times = []
+        self.rows = []
+        self.offset = None
+
+    def _anchorName(self):
+        tmpPath = s.getEnvironmentVariable("ALLSKY_TMP")
+        if tmpPath is None:
+            return None
+
+        return os.path.join(tmpPath, self.anchorFile)
+
+    def _anchor(self, now):
+        ''' The wall time the first row of a relative trace was replayed at '''
+        anchorName = self._anchorName()
+        if anchorName is not None and os.path.exists(anchorName):
+            try:
+                with open(anchorName) as file:
+                    saved = json.load(file)
+                if saved["file"] == self.fileName and saved["modified"] == self.modified and float(saved["start"]) <= now:
+                    return float(saved["start"])
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                s.log(4, f"ERROR: Module replaySensor ignoring unreadable {anchorName} - {e}")
+
+        if anchorName is not None:
+            saved = {"file": self.fileName, "modified": self.modified, "start": now}
+            tmpFile = None
+            try:
+                handle, tmpFile = tempfile.mkstemp(dir=os.path.dirname(anchorName), suffix=".tmp")
+                with os.fdopen(handle, "w") as file:
+                    json.dump(saved, file)
+                os.replace(tmpFile, anchorName)
+            except OSError as e:
+                s.log(4, f"ERROR: Module replaySensor unable to write {anchorName} - {e}")
+                if tmpFile is not None and os.path.exists(tmpFile):
+                    os.remove(tmpFile)
+
+        return now
+
+    def _load(self, fileName):
+        rows = []
+        if fileName.endswith((".npy", ".npz")):
+            data = np.load(fileName)
+            if fileName.endswith(".npz"):
+                data = data[data.files[0]]
+            rows = data.tolist()
+        else:
+            with open(fileName, newline="") as file:
+                for row in csv.reader(file):
+                    try:
+                        rows.append([float(value) for value in row])
+                    except ValueError:
+                        pass
+
+        rows.sort()
+        self.rows = rows
+        self.times = [row[0] for row in rows]
+        self.offset = None
+
+    def read(self, fileName):
+        now = time.time()
+        try:
+            modified = os.path.getmtime(fileName)
+            if fileName != self.fileName or modified != self.modified:
+                self._load(fileName)
+                self.fileName = fileName
+                self.modified = modified
+        except (OSError, ValueError) as e:
+            eType, eObject, eTraceback = sys.exc_info()
+            s.log(0, f"ERROR: Module replaySensor failed on line {eTraceback.tb_lineno} - {e}")
+            self.fileName = None
+            return sensorSample(now)
+
+        if len(self.rows) == 0:
+            return sensorSample(now)
+        if self.offset is None:
+            self.offset = self._anchor(now) - self.times[0] if self.times[0] < 1e9 else 0
+        traceTime = now - self.offset
+        step = self.times[-1] - self.times[-2] if len(self.times) > 1 else 0
+        index = bisect.bisect_right(self.times, traceTime) - 1
+        if index < 0 or traceTime > self.times[-1] + step:
+            return sensorSample(now)
+
+        row = self.rows[index]
+        return sensorSample(now, row[1], row[2], row[3] if len(row) > 3 else None)
+
+replay = replaySensor()
+
+class sensorSampler():
+    '''
+    Reads the sensor in a background thread every interval seconds into a fixed size ring buffer
+    of sensorSamples, so slow reads like the DHT retries never block the periodic jobs. latest()
+    returns the newest valid sample without waiting, ready is set once the first read is done.
+    '''
+
+    def __init__(self, key, interval, capacity=32):
+        self.key = key
+        self.interval = interval
+        self.samples = [None] * capacity
+        self.next = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="allsky_dewheater sampler", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            started = time.monotonic()
+            try:
+                sample = readSources(*self.key)
+            except Exception as e:
+                eType, eObject, eTraceback = sys.exc_info()
+                s.log(0, f"ERROR: Module sensorSampler failed on line {eTraceback.tb_lineno} - {e}")
+                sample = None
+
+            if sample is not None:
+                with self.lock:
+                    self.samples[self.next] = sample
+                    self.next = (self.next + 1) % len(self.samples)
+            self.ready.set()
+            self.stopped.wait(max(0, self.interval - (time.monotonic() - started)))
+
+    def latest(self, staleness):
+        '''
+        Returns the newest sample with a temperature and humidity that is at most staleness
+        seconds old, zero disables the age check, or None if there is none
+        '''
+        now = time.time()
+        with self.lock:
+            for i in range(1, len(self.samples) + 1):
+                sample = self.samples[(self.next - i) % len(self.samples)]
+                if sample is None or (staleness != 0 and now - sample.timestamp > staleness):
+                    break
+                if sample.temperature is not None and sample.humidity is not None:
+                    return sample
+
+        return None
+
+    def stop(self):
+        self.stopped.set()
+
+sampler = None
+
+def startSampler(key, interval):
+    global sampler
+
+    if sampler is not None and (sampler.key != key or sampler.interval != interval):
+        stopSampler()
+    if sampler is None:
+        s.log(4, f"INFO: Starting background sensor sampling every {interval}s")
+        sampler = sensorSampler(key, interval)
+
+    return sampler
+
+def stopSampler():
+    global sampler
+
+    if sampler is not None:
+        sampler.stop()
+        sampler = None
+
+sensorLocks = {}
+sensorLocksLock = threading.Lock()
+
+def readSensor(sensorType, inputpin, i2caddress, dhtxxretrycount, dhtxxdelay, sht31heater, soloSettings, replayFile=""):
+    # one read at a time per device, a bit-banged DHT read is corrupted by a second one
+    with sensorLocksLock:
+        lock = sensorLocks.setdefault((sensorType, inputpin, i2caddress), threading.Lock())
+    with lock:
+        return _readSensor(sensorType, inputpin, i2caddress, dhtxxretrycount, dhtxxdelay, sht31heater, soloSettings, replayFile)
+
+def _readSensor(sensorType, inputpin, i2caddress, dhtxxretrycount, dhtxxdelay, sht31heater, soloSettings, replayFile):
+    if sensorType in I2C_SENSORS:
+        sample = sensors.read(sensorType, i2caddress=i2caddress, sht31heater=sht31heater)
+    elif sensorType in DHT_SENSORS:
+        sample = readDHT22(inputpin, dhtxxretrycount, dhtxxdelay)
     elif sensorType == "SOLO-Cloudwatcher":
-        temperature, humidity, pressure, dewPoint = readSolo(soloURL)         
+        sample = readSolo(*soloSettings)
+    elif sensorType == "Replay":
+        sample = replay.read(replayFile)
     else:
         s.log(0,"ERROR: No sensor type defined")
+        sample = sensorSample(time.time())
+
+    return sample
+
+pending = {}
+pendingLock = threading.Lock()
+
+def _readInBackground(source):
+    '''
+    Starts reading the source in a daemon thread, so a sensor still being read after the deadline
+    never keeps the process alive, and returns the Future of its sample
+    '''
+    future = concurrent.futures.Future()
+
+    def run():
+        try:
+            future.set_result(readSensor(*source))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name="allsky_dewheater {}".format(source[0]), daemon=True).start()
+
+    return future
+
+def readSources(sources, fusion, deadline, staleness):
+    '''
+    Reads all the sources, each a tuple of readSensor arguments, at the same time in background
+    threads and fuses the samples that arrive within deadline seconds, zero waits for all of them.
+    A source still being read is not read again. When the module stays loaded between runs its
+    sample is used by a later run if it is not too old by then, otherwise it is lost with the
+    process.
+    '''
+    if len(sources) == 1 and deadline == 0:
+        return readSensor(*sources[0])
+
+    futures = []
+    with pendingLock:
+        for source in sources:
+            if source not in pending:
+                pending[source] = _readInBackground(source)
+            futures.append(pending[source])
+
+    done, notDone = concurrent.futures.wait(futures, timeout=deadline if deadline > 0 else None)
+    samples = []
+    for source, future in zip(sources, futures):
+        if future in done:
+            with pendingLock:
+                if pending.get(source) is future:
+                    del pending[source]
+            try:
+                samples.append(future.result())
+            except Exception as e:
+                s.log(0, f"ERROR: Module readSources failed to read {source[0]} - {e}")
+        else:
+            s.log(4, f"INFO: No {source[0]} reading within {deadline}s")
+
+    return fuseSamples(samples, fusion, staleness)
+
+def fuseSamples(samples, fusion, staleness):
+    '''
+    Combines the samples with a temperature and humidity that are at most staleness seconds old.
+    Median takes the median of every value, Priority the first sample in the order of the sources
+    '''
+    now = time.time()
+    valid = [sample for sample in samples if sample.temperature is not None and sample.humidity is not None \
+        and (staleness == 0 or now - sample.timestamp <= staleness)]
+    s.log(4, f"INFO: Using {len(valid)} of {len(samples)} sensor readings")
+
+    if len(valid) == 0:
+        return sensorSample(now)
+    if fusion == "Priority" or len(valid) == 1:
+        return valid[0]
+
+    values = []
+    for field in sensorSample._fields[1:]:
+        fieldValues = [getattr(sample, field) for sample in valid if getattr(sample, field) is not None]
+        values.append(statistics.median(fieldValues) if len(fieldValues) > 0 else None)
+
+    return sensorSample(min(sample.timestamp for sample in valid), *values)
+
+def cToF(temperature):
+    return temperature * 9 / 5.0 + 32
+
+def fToC(temperature):
+    return (temperature - 32) * 5 / 9.0
+
+def calcDewPoint(temperature, humidity):
+    '''
+    Dew point in C from the temperature in C and the relative humidity in % (1-100), with the
+    Arden Buck constants for positive and negative temperatures as used by meteocalc. Works on
+    single values, where a humidity out of range raises a ValueError, and on NumPy arrays, where
+    it gives NaN.
+    '''
+    if isinstance(temperature, (int, float)) and isinstance(humidity, (int, float)):
+        if humidity < 1 or humidity > 100:
+            raise ValueError('Incorrect value for humidity: "{}". Correct range 1-100.'.format(humidity))
+        b, c = (17.368, 238.88) if temperature > 0 else (17.966, 247.15)
+        pa = math.log(humidity / 100.0) + b * temperature / (c + temperature)
+        return c * pa / (b - pa)
+
+    temperature = np.asarray(temperature, dtype=np.float64)
+    humidity = np.where((humidity < 1) | (humidity > 100), np.nan, np.asarray(humidity, dtype=np.float64))
+    positive = temperature > 0
+    b = np.where(positive, 17.368, 17.966)
+    c = np.where(positive, 238.88, 247.15)
+    pa = np.log(humidity / 100.0) + b * temperature / (c + temperature)
+
+    return c * pa / (b - pa)
+
+def _rothfusz(t, humidity):
+    return -42.379 + 2.04901523 * t + 10.14333127 * humidity - 0.22475541 * t * humidity \
+        - 6.83783e-3 * t * t - 5.481717e-2 * humidity * humidity + 1.22874e-3 * t * t * humidity \
+        + 8.5282e-4 * t * humidity * humidity - 1.99e-6 * t * t * humidity * humidity
+
+def calcHeatIndex(temperature, humidity):
+    '''
+    Heat index in C from the temperature in C and the relative humidity in %, the NOAA simple
+    formula below 80F and the Rothfusz regression above as used by meteocalc, for single values
+    or NumPy arrays
+    '''
+    t = cToF(temperature)
+    heatIndex = 0.5 * (t + 61.0 + (t - 68.0) * 1.2 + humidity * 0.094)
+    if isinstance(heatIndex, float):
+        if heatIndex >= 80:
+            heatIndex = _rothfusz(t, humidity)
+        return fToC(heatIndex)
+
+    return fToC(np.where(heatIndex >= 80, _rothfusz(t, humidity), heatIndex))
+
+processReads = 0
+
+def getSensorReading(sources, fusion="Median", deadline=0, interval=0, staleness=0):
+    global processReads
+
+    heatIndex = None
+
+    # allsky usually runs the module in a new process every time, the sampler is only started
+    # once a second reading in the same process shows the module stays loaded between runs
+    key = (tuple(sources), fusion, deadline, staleness)
+    if interval > 0 and processReads > 0:
+        activeSampler = startSampler(key, interval)
+        activeSampler.ready.wait()
+        sample = activeSampler.latest(staleness)
+        if sample is None:
+            s.log(4, f"INFO: No background sensor sample newer than {staleness}s")
+            sample = sensorSample(time.time())
+    else:
+        stopSampler()
+        sample = readSources(*key)
+        if staleness != 0 and time.time() - sample.timestamp > staleness:
+            s.log(4, f"INFO: The sensor reading is older than {staleness}s")
+            sample = sensorSample(time.time())
+    processReads = processReads + 1
+    temperature, humidity, pressure, relHumidity, altitude, dewPoint = sample[1:]
 
     if temperature is not None and humidity is not None:
-        dewPoint = dew_point(temperature, humidity).c
-        heatIndex = heat_index(temperature, humidity).c
+        dewPoint = calcDewPoint(temperature, humidity)
+        heatIndex = calcHeatIndex(temperature, humidity)
 
         tempUnits = s.getSetting("temptype")
         if tempUnits == 'F':
-            temperature = (temperature * (9/5)) + 32
-            dewPoint = (dewPoint * (9/5)) + 32
-            heatIndex = (heatIndex * (9/5)) + 32
+            temperature = cToF(temperature)
+            dewPoint = cToF(dewPoint)
+            heatIndex = cToF(heatIndex)
             s.log(4,"INFO: Converted temperature to F")
 
         temperature = round(temperature, 2)
@@ -533,13 +1339,48 @@ def getSensorReading(sensorType, inputpin, i2caddress, dhtxxretrycount, dhtxxdel
 
     return temperature, humidity, dewPoint, heatIndex, pressure, relHumidity, altitude
 
-def getLastRunTime():
-    lastRun = None
+def predictHeater(state, now, temperature, dewPoint, limit, hysteresis, lookahead, frequency, maxDelay):
+    '''
+    Predictive dew control. The dew margin, temperature minus dew point, of the recent readings
+    is kept in the heater state and its slope fitted by least squares. The heater is switched on
+    when the margin is within the limit or is predicted to be within lookahead seconds, and only
+    switched off again once the margin and its prediction are more than hysteresis degrees
+    outside the limit, so it does not chatter around the threshold. While the heater is off and
+    the margin is large and not closing fast the next reading is delayed, up to maxDelay seconds.
+    Returns if the heater should be on, the seconds to wait before the next reading and the
+    predicted margin.
+    '''
+    margin = temperature - dewPoint
+    history = [entry for entry in state.get("history", []) if now - entry[0] <= 2 * lookahead]
+    history = (history + [[now, round(margin, 2)]])[-16:]
+    state.set("history", history)
 
-    if s.dbHasKey("dewheaterlastrun"):
-        lastRun = s.dbGet("dewheaterlastrun")
+    slope = 0
+    if len(history) >= 3:
+        meanTime = sum(entry[0] for entry in history) / len(history)
+        meanMargin = sum(entry[1] for entry in history) / len(history)
+        spread = sum((entry[0] - meanTime) ** 2 for entry in history)
+        if spread > 0:
+            slope = sum((entry[0] - meanTime) * (entry[1] - meanMargin) for entry in history) / spread
+    predicted = margin + min(slope, 0) * lookahead
 
-    return lastRun
+    heaterOn = state.get("ontime") is not None
+    if margin <= limit or predicted <= limit:
+        heaterOn = True
+    elif margin > limit + hysteresis and predicted > limit + hysteresis:
+        heaterOn = False
+
+    wait = frequency
+    if not heaterOn and maxDelay > frequency and margin > limit + 2 * hysteresis:
+        if slope >= 0:
+            wait = maxDelay
+        else:
+            wait = min(max(((margin - limit) / -slope - lookahead) / 2, frequency), maxDelay)
+
+    return heaterOn, int(wait), predicted
+
+def getLastRunTime(state):
+    return state.get("lastrun")
 
 def debugOutput(sensorType, temperature, humidity, dewPoint, heatIndex, pressure, relHumidity, altitude):
     s.log(1,f"INFO: Sensor {sensorType} read. Temperature {temperature} Humidity {humidity} Relative Humidity {relHumidity} Dew Point {dewPoint} Heat Index {heatIndex} Pressure {pressure} Altitude {altitude}")
@@ -565,17 +1406,38 @@ def dewheater(params, event):
     except ValueError:
         inputpin = 0
     frequency = int(params["frequency"])
+    control = params.get("control", "Threshold")
+    lookahead = int(params.get("lookahead", 900))
+    hysteresis = float(params.get("hysteresis", 1))
+    maxdelay = int(params.get("maxdelay", 600))
     maxontime = int(params["max"])
     i2caddress = params["i2caddress"]
     dhtxxretrycount = int(params["dhtxxretrycount"])
     dhtxxdelay = int(params["dhtxxdelay"])
     extradatafilename = params['extradatafilename']
     sht31heater = params["sht31heater"]
+    sampling = int(params.get("sampling", 0))
+    staleness = int(params.get("staleness", 60))
+    pins.refresh = int(params.get("pinrefresh", 300))
+    historyfile = params.get("historyfile", "dewheater_history.bin")
+    dutywindow = int(params.get("dutywindow", 3600))
+    heaterwatts = float(params.get("heaterwatts", 0))
 
     try:
         soloURL = params["solourl"]
     except ValueError:
         soloURL = ''
+    soloSettings = (soloURL, int(params.get("solotimeout", 5)), int(params.get("solocache", 10)))
+    fusion = params.get("fusion", "Median")
+    deadline = float(params.get("deadline", 0))
+
+    # the main sensor first, then any extra ones with their own optional i2c address
+    replayFile = params.get("replayfile", "")
+    sources = [(sensorType, inputpin, i2caddress, dhtxxretrycount, dhtxxdelay, sht31heater, soloSettings, replayFile)]
+    for extraSensor in params.get("extrasensors", "").split(","):
+        if extraSensor.strip() != "":
+            extraType, separator, extraAddress = extraSensor.strip().partition(":")
+            sources.append((extraType.strip(), inputpin, extraAddress.strip(), dhtxxretrycount, dhtxxdelay, sht31heater, soloSettings, replayFile))
                 
     temperature = 0
     humidity = 0
@@ -595,48 +1457,63 @@ def dewheater(params, event):
             heaterpin = s.getGPIOPin(heaterpin)
             if extrapin !=0:
                 extrapin = s.getGPIOPin(extrapin)
-            lastRunTime = getLastRunTime()
+            state = heaterState()
+            lastRunTime = getLastRunTime(state)
             if lastRunTime is not None:
                 now = int(time.time())
                 lastRunSecs = now - lastRunTime
-                if lastRunSecs >= frequency:
-                    s.dbUpdate("dewheaterlastrun", now)
-                    temperature, humidity, dewPoint, heatIndex, pressure, relHumidity, altitude = getSensorReading(sensorType, inputpin, i2caddress, dhtxxretrycount, dhtxxdelay, sht31heater, soloURL)
+                wait = max(frequency, state.get("wait", 0))
+                if lastRunSecs >= wait:
+                    state.set("lastrun", now)
+                    state.delete("wait")
+                    temperature, humidity, dewPoint, heatIndex, pressure, relHumidity, altitude = getSensorReading(sources, fusion, deadline, sampling, staleness)
                     if temperature is not None:
                         lastOnSecs = 0
-                        if s.dbHasKey("dewheaterontime"):
-                            lastOnTime = s.dbGet("dewheaterontime")
-                            lastOnSecs = now - lastOnTime
+                        if state.get("ontime") is not None:
+                            lastOnSecs = now - state.get("ontime")
                         if maxontime != 0 and lastOnSecs >= maxontime:
                             result = "Heater was on longer than maximum allowed time {}".format(maxontime)
                             s.log(1,"INFO: {}".format(result))
-                            turnHeaterOff(heaterpin, invertrelay)
+                            turnHeaterOff(heaterpin, invertrelay, state=state)
                             if extrapin != 0:
-                                turnHeaterOff(extrapin, invertextrapin, True)
+                                turnHeaterOff(extrapin, invertextrapin, True, state)
                             heater = 'Off'
                         elif force != 0 and temperature <= force:
                             result = "Temperature below forced level {}".format(force)
                             s.log(1,"INFO: {}".format(result))
-                            turnHeaterOn(heaterpin, invertrelay)
+                            turnHeaterOn(heaterpin, invertrelay, state=state)
                             if extrapin != 0:
-                                turnHeaterOn(extrapin, invertextrapin, True)
+                                turnHeaterOn(extrapin, invertextrapin, True, state)
                             heater = 'On'
                         else:
-                            if ((temperature-limit) <= dewPoint):
-                                turnHeaterOn(heaterpin, invertrelay)
+                            if control == "Predictive":
+                                heaterOn, wait, predicted = predictHeater(state, now, temperature, dewPoint, limit, hysteresis, lookahead, frequency, maxdelay)
+                                state.set("wait", wait)
+                                s.log(4, "INFO: Dew margin {:.2f} predicted {:.2f} in {}s, next reading in {}s".format(temperature - dewPoint, predicted, lookahead, wait))
+                            else:
+                                heaterOn = (temperature-limit) <= dewPoint
+                                state.delete("history")
+
+                            if heaterOn:
+                                turnHeaterOn(heaterpin, invertrelay, state=state)
                                 if extrapin != 0:
-                                    turnHeaterOn(extrapin, invertextrapin)
+                                    turnHeaterOn(extrapin, invertextrapin, True, state)
                                 heater = 'On'
-                                result = "Temperature within limit temperature {}, limit {}, dewPoint {}".format(temperature, limit, dewPoint)
+                                if (temperature-limit) <= dewPoint:
+                                    result = "Temperature within limit temperature {}, limit {}, dewPoint {}".format(temperature, limit, dewPoint)
+                                else:
+                                    result = "Temperature predicted within limit temperature {}, limit {}, dewPoint {}".format(temperature, limit, dewPoint)
                                 s.log(1,"INFO: {}".format(result))
                             else:
                                 result = "Temperature outside limit temperature {}, limit {}, dewPoint {}".format(temperature, limit, dewPoint)
                                 s.log(1,"INFO: {}".format(result))
-                                turnHeaterOff(heaterpin, invertrelay)
+                                turnHeaterOff(heaterpin, invertrelay, state=state)
                                 if extrapin != 0:
-                                    turnHeaterOff(extrapin, invertextrapin, True)
+                                    turnHeaterOff(extrapin, invertextrapin, True, state)
                                 heater = 'Off'
                             
+                        energy = updateHistory(historyfile, state, now, heater, temperature, dewPoint, dutywindow)
+
                         extraData = {}
                         extraData["AS_DEWCONTROLAMBIENT"] = str(temperature)
                         extraData["AS_DEWCONTROLDEW"] = str(dewPoint)
@@ -648,6 +1525,12 @@ def dewheater(params, event):
                             extraData["AS_DEWCONTROLRELHUMIDITY"] = relHumidity
                         if altitude is not None:
                             extraData["AS_DEWCONTROLALTITUDE"] = altitude
+                        if energy is not None:
+                            duty, onToday = energy
+                            extraData["AS_DEWCONTROLDUTY"] = "{:.1f}".format(duty)
+                            extraData["AS_DEWCONTROLONTODAY"] = str(int(onToday))
+                            if heaterwatts > 0:
+                                extraData["AS_DEWCONTROLWHTODAY"] = "{:.1f}".format(onToday * heaterwatts / 3600)
 
                         s.saveExtraData(extradatafilename,extraData)
 
@@ -658,22 +1541,24 @@ def dewheater(params, event):
                         s.log(0, "ERROR: {}".format(result))
                         s.deleteExtraData(extradatafilename)
                 else:
-                    result = "Not run. Only running every {}s. Last ran {}s ago".format(frequency, lastRunSecs)
+                    result = "Not run. Only running every {}s. Last ran {}s ago".format(wait, lastRunSecs)
                     s.log(1,"INFO: {}".format(result))
             else:
                 now = int(time.time())
-                s.dbAdd("dewheaterlastrun", now)
+                state.set("lastrun", now)
                 s.log(1,"INFO: No last run info so assuming startup")
                 if heaterstartupstate == "ON":
-                    turnHeaterOn(heaterpin, invertrelay)
+                    turnHeaterOn(heaterpin, invertrelay, state=state)
                     if extrapin != 0:
-                        turnHeaterOn(extrapin, invertextrapin)
+                        turnHeaterOn(extrapin, invertextrapin, True, state)
                     heater = 'On'
                 else:
-                    turnHeaterOff(heaterpin, invertrelay)
+                    turnHeaterOff(heaterpin, invertrelay, state=state)
                     if extrapin != 0:
-                        turnHeaterOff(extrapin, invertextrapin)
+                        turnHeaterOff(extrapin, invertextrapin, True, state)
                     heater = 'Off'
+                updateHistory(historyfile, state, now, heater, window=dutywindow)
+            state.flush()
         else:
             s.deleteExtraData(extradatafilename)
             result = "heater pin not defined or invalid"
@@ -688,6 +1573,8 @@ def dewheater(params, event):
     return result
 
 def dewheater_cleanup():
+    stopSampler()
+    history.close()
     moduleData = {
         "metaData": metaData,
         "cleanup": {
@@ -0,0 +1,250 @@
+'''
+replay_dewheater.py
+
+Runs the allsky_dewheater control loop over a recorded or synthetic night faster than real time,
+on any Linux box. allsky_shared, the board, the Adafruit sensor drivers and digitalio are replaced
+by small stubs, the sensor is the Replay sensor type and the heater pins are a fake GPIO sink
+that records every transition. The clock the module sees is simulated, every periodic run moves
+it on by the step.
+
+The results are written as JSON: the heater transitions, the time the heater was on, the number
+of sensor reads, the duty cycle and energy variables of the last reading and the per run
+latency of dewheater() in ms. The heater history file is written to a temporary folder.
+
+    python3 replay_dewheater.py night.csv -p params.json -o results.json
+    python3 replay_dewheater.py --synthetic 12
+'''
+import os
+import sys
+import csv
+import json
+import math
+import time
+import types
+import argparse
+import tempfile
+
+class virtualClock():
+    ''' The simulated time, dewheater sleeps only move it on '''
+
+    def __init__(self, start):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now = self.now + seconds
+
+class gpioSink():
+    ''' Fake DigitalInOut factory that records every value written to a pin '''
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.writes = []
+        self.levels = {}
+        sink = self
+
+        class DigitalInOut():
+            def __init__(self, pin):
+                self.pin = pin
+                self.direction = None
+
+            def switch_to_output(self, value=False, **kwargs):
+                self.direction = "output"
+                self.value = value
+
+            @property
+            def value(self):
+                return sink.levels.get(str(self.pin))
+
+            @value.setter
+            def value(self, value):
+                sink.writes.append([sink.clock.time(), str(self.pin), int(value)])
+                sink.levels[str(self.pin)] = int(value)
+
+        self.DigitalInOut = DigitalInOut
+
+    def transitions(self, pin):
+        ''' The writes to the pin that changed its level '''
+        changes = []
+        for timestamp, name, value in self.writes:
+            if name == str(pin) and (len(changes) == 0 or changes[-1][1] != value):
+                changes.append([timestamp, value])
+
+        return changes
+
+def stubModules(clock, sink, settings, tmpPath):
+    shared = types.ModuleType("allsky_shared")
+    shared.db = {}
+    shared.lastRun = {}
+    shared.extraData = {}
+
+    def shouldRun(module, frequency):
+        diff = clock.time() - shared.lastRun.get(module, 0)
+        return diff >= frequency, diff
+
+    shared.log = lambda level, message: None
+    shared.getSetting = lambda name: settings.get(name)
+    shared.getEnvironmentVariable = lambda name, fatal=False, error='': tmpPath if name == "ALLSKY_TMP" else os.environ.get(name)
+    shared.getGPIOPin = lambda pin: "GPIO{}".format(pin)
+    shared.shouldRun = shouldRun
+    shared.setLastRun = lambda module: shared.lastRun.__setitem__(module, clock.time())
+    shared.saveExtraData = lambda fileName, extraData: shared.extraData.update(extraData)
+    shared.deleteExtraData = lambda fileName: shared.extraData.clear()
+    shared.cleanupModule = lambda moduleData: None
+    shared.dbHasKey = lambda key: key in shared.db
+    shared.dbGet = lambda key: shared.db[key]
+    shared.dbAdd = lambda key, value: shared.db.__setitem__(key, value)
+    shared.dbUpdate = lambda key, value: shared.db.__setitem__(key, value)
+    shared.dbDeleteKey = lambda key: shared.db.pop(key, None)
+    sys.modules["allsky_shared"] = shared
+
+    digitalio = types.ModuleType("digitalio")
+    digitalio.DigitalInOut = sink.DigitalInOut
+    digitalio.Direction = types.SimpleNamespace(INPUT="input", OUTPUT="output")
+    digitalio.Pull = types.SimpleNamespace(UP="up", DOWN="down")
+    sys.modules["digitalio"] = digitalio
+
+    # the hardware drivers are never used by the Replay sensor
+    for name in ("board", "adafruit_sht31d", "adafruit_dht", "adafruit_ahtx0", "adafruit_bme280", "adafruit_bme280.basic", "adafruit_htu21d"):
+        sys.modules[name] = types.ModuleType(name)
+    sys.modules["adafruit_bme280"].basic = sys.modules["adafruit_bme280.basic"]
+    sys.modules["adafruit_htu21d"].HTU21D = None
+
+    # the Solo client is not used either, only needed if requests is not installed
+    try:
+        import requests
+    except ImportError:
+        sys.modules["requests"] = types.ModuleType("requests")
+
+    return shared
+
+def syntheticNight(fileName, hours, step=60):
+    '''
+    Writes a night where the temperature falls from 12C to 4C while the dew point closes in on it,
+    from 14C away down to 5C in the middle of the night and back again, so the default limit of
+    10C is crossed both ways, with some sensor noise
+    '''
+    b, c = 17.368, 238.88
+    with open(fileName, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["time", "temperature", "humidity", "pressure"])
+        for i in range(int(hours * 3600 / step) + 1):
+            t = i * step
+            fraction = t / (hours * 3600)
+            temperature = 12.0 - 8.0 * fraction + 0.3 * math.sin(t / 97.0)
+            dewPoint = temperature - 14.0 + 9.0 * math.sin(math.pi * fraction)
+            humidity = 100.0 * math.exp(b * dewPoint / (c + dewPoint) - b * temperature / (c + temperature))
+            humidity = min(98.0, humidity + 1.5 * math.sin(t / 53.0))
+            writer.writerow([t, round(temperature, 2), round(humidity, 2), 1013.0])
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays a night through the allsky_dewheater control loop")
+    parser.add_argument("trace", nargs="?", help="CSV or NumPy file of time, temperature, humidity and optional pressure")
+    parser.add_argument("--synthetic", type=float, metavar="HOURS", help="Replay a synthetic night of this many hours instead")
+    parser.add_argument("-p", "--params", help="JSON file with module parameters overriding the defaults")
+    parser.add_argument("-s", "--step", type=float, default=60, help="Seconds between periodic runs, default 60")
+    parser.add_argument("--temptype", default="C", help="Temperature units setting, C or F")
+    parser.add_argument("-o", "--output", help="JSON results file, printed when not given")
+    args = parser.parse_args()
+
+    if args.trace is None and args.synthetic is None:
+        parser.error("a trace file or --synthetic is needed")
+    tmpPath = tempfile.mkdtemp(prefix="dewheater-replay-")
+    trace = args.trace
+    if trace is None:
+        trace = os.path.join(tmpPath, "night.csv")
+        syntheticNight(trace, args.synthetic)
+
+    start = 1700000000.0
+    clock = virtualClock(start)
+    sink = gpioSink(clock)
+    shared = stubModules(clock, sink, {"temptype": args.temptype}, tmpPath)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import allsky_dewheater as dh
+
+    # the module sees the simulated clock, everything else about time is the real module
+    virtualTime = types.ModuleType("time")
+    virtualTime.__dict__.update(time.__dict__)
+    virtualTime.time = clock.time
+    virtualTime.monotonic = clock.monotonic
+    virtualTime.sleep = clock.sleep
+    dh.time = virtualTime
+    # the simulated night is long before the real boot of this machine
+    dh.pins.bootTime = 0
+
+    params = {}
+    for name, value in dh.metaData["arguments"].items():
+        if isinstance(value, str) and value.lower() in ("true", "false"):
+            value = value.lower() == "true"
+        params[name] = value
+    params.update({"type": "Replay", "heaterpin": "17", "frequency": "0"})
+    if args.params is not None:
+        with open(args.params) as file:
+            params.update(json.load(file))
+    params["replayfile"] = trace
+
+    reads = [0]
+    replayRead = dh.replay.read
+    def countedRead(fileName):
+        reads[0] = reads[0] + 1
+        return replayRead(fileName)
+    dh.replay.read = countedRead
+
+    latencies = []
+    results = {}
+    energy = {}
+    while True:
+        started = time.perf_counter()
+        result = dh.dewheater(params, "periodic")
+        latencies.append((time.perf_counter() - started) * 1000.0)
+        # the readings are left out so the same outcomes are counted together
+        outcome = result.split(" temperature ")[0].split(". Last ran")[0]
+        results[outcome] = results.get(outcome, 0) + 1
+        if "AS_DEWCONTROLDUTY" in shared.extraData:
+            energy = {name: value for name, value in shared.extraData.items() if name[13:] in ("DUTY", "ONTODAY", "WHTODAY")}
+        if result == "Failed to read sensor" and reads[0] > 0:
+            break
+        clock.sleep(args.step)
+
+    pin = shared.getGPIOPin(params["heaterpin"])
+    onLevel = 0 if params["invertrelay"] in (True, "True", "true") else 1
+    transitions = sink.transitions(pin)
+    onSeconds = 0
+    for (timestamp, value), following in zip(transitions, transitions[1:] + [[clock.time(), None]]):
+        if value == onLevel:
+            onSeconds = onSeconds + following[0] - timestamp
+
+    output = {
+        "trace": trace,
+        "simulatedHours": round((clock.time() - start) / 3600.0, 3),
+        "runs": len(latencies),
+        "sensorReads": reads[0],
+        "pinWrites": len(sink.writes),
+        "heaterTransitions": [[round(timestamp - start), "On" if value == onLevel else "Off"] for timestamp, value in transitions],
+        "heaterOnHours": round(onSeconds / 3600.0, 3),
+        "results": results,
+        "energy": energy,
+        "latencyMs": {
+            "median": round(percentile(latencies, 0.5), 3),
+            "p95": round(percentile(latencies, 0.95), 3),
+            "max": round(max(latencies), 3)
+        }
+    }
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(output, file, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+
+if __name__ == "__main__":
+    main()
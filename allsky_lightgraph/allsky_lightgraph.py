@@ -13,11 +13,16 @@ Expected parameters:
 '''
 import allsky_shared as s
 import os
+import sys
+import json
+import argparse
+import tempfile
+import time
 import ephem
 import datetime
 import cv2
 import numpy as np
-from math import degrees
+from multiprocessing import Pool
 
 metaData = {
     "name": "Light Graph",
@@ -33,6 +38,7 @@ metaData = {
         "border_color": "30 190 40",
         "light_color": "240 240 240",
         "dark_color": "10 10 10",
+        "band_gradient": "false",
         "width": 800,
         "height": 25,
         "alpha": 1.0,
@@ -52,6 +58,9 @@ metaData = {
         "elev_vert_pos": 10,
         "elev_width": 300,
         "elev_height": 100,
+        "elev_below": "true",
+        "elev_error": 0.5,
+        "timing_frames": 100,
         "debug": "False"
     },
     "argumentdetails": {
@@ -82,6 +91,15 @@ metaData = {
                 "fieldtype": ""
             }
         },
+        "band_gradient": {
+            "required": "false",
+            "description": "Smooth twilight colors",
+            "help": "Blend the fill colors between the twilight phases instead of drawing solid steps",
+            "tab": "Colors",
+            "type": {
+                "fieldtype": "checkbox"
+            }
+        },
         "width": {
             "required": "true",
             "description": "Width",
@@ -275,6 +293,39 @@ metaData = {
                 "step": 1
             }
         },
+        "elev_below": {
+            "required": "false",
+            "description": "Draw paths below horizon",
+            "help": "If not selected the sun and moon paths are only drawn while above the horizon",
+            "tab": "Elevation",
+            "type": {
+                "fieldtype": "checkbox"
+            }
+        },
+        "elev_error": {
+            "required": "true",
+            "description": "Path precision",
+            "help": "Largest distance in pixels between the drawn sun and moon paths and the real curves, smaller calculates more points. The paths are never sampled more than once per pixel column",
+            "tab": "Elevation",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0.1,
+                "max": 5.0,
+                "step": 0.1
+            }
+        },
+        "timing_frames": {
+            "required": "true",
+            "description": "Timing frames",
+            "help": "Number of images the median and 95th percentile of the phase timings in the extra data are worked out over, zero will disable the timings",
+            "tab": "Debug",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 1000,
+                "step": 1
+            }
+        },
        "debug": {
             "required": "false",
             "description": "Enable debug mode",
@@ -288,21 +339,557 @@ metaData = {
     }
 }
 
-class lGraph():
+def _timestamp(utcTime):
+    return utcTime.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+def _utcDatetime(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).replace(tzinfo=None)
+
+def _replaceFile(fileName, save):
+    '''
+    Writes a file with save(file) into a temporary file of its own in the same folder and renames
+    it over fileName, so processes writing the same file at once never mix or see partial files
+    '''
+    handle, tmpFile = tempfile.mkstemp(dir=os.path.dirname(fileName), suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as file:
+            save(file)
+        os.replace(tmpFile, fileName)
+    except BaseException:
+        try:
+            os.remove(tmpFile)
+        except OSError:
+            pass
+        raise
+
+def sunMoonAltitude(timestamps, latitude, longitude):
+    '''
+    Low precision sun and moon altitudes in degrees for an array of UTC unix timestamps, using the
+    Astronomical Almanac series. Compared to ephem the sun is within 0.1 degrees and the topocentric
+    moon within 0.5 degrees, both with the same standard refraction, which is well below one pixel
+    of the elevation chart.
+    '''
+    n = np.asarray(timestamps, dtype=np.float64) / 86400.0 - 10957.5 # days since J2000.0
+    T = n / 36525.0
+    rad = np.radians
+    obliquity = rad(23.439 - 0.0000004 * n)
+    sunRA, sunDec = _sunEquatorial(n)
+
+    # moon, ecliptic longitude, latitude and horizontal parallax
+    moonLon = rad(218.32 + 481267.881 * T \
+        + 6.29 * np.sin(rad(135.0 + 477198.87 * T)) - 1.27 * np.sin(rad(259.3 - 413335.36 * T)) \
+        + 0.66 * np.sin(rad(235.7 + 890534.22 * T)) + 0.21 * np.sin(rad(269.9 + 954397.74 * T)) \
+        - 0.19 * np.sin(rad(357.5 + 35999.05 * T)) - 0.11 * np.sin(rad(186.5 + 966404.03 * T)))
+    moonLat = rad(5.13 * np.sin(rad(93.3 + 483202.02 * T)) + 0.28 * np.sin(rad(228.2 + 960400.89 * T)) \
+        - 0.28 * np.sin(rad(318.3 + 6003.15 * T)) - 0.17 * np.sin(rad(217.6 - 407332.21 * T)))
+    parallax = 0.9508 + 0.0518 * np.cos(rad(135.0 + 477198.87 * T)) + 0.0095 * np.cos(rad(259.3 - 413335.36 * T)) \
+        + 0.0078 * np.cos(rad(235.7 + 890534.22 * T)) + 0.0028 * np.cos(rad(269.9 + 954397.74 * T))
+    l = np.cos(moonLat) * np.cos(moonLon)
+    m = np.cos(obliquity) * np.cos(moonLat) * np.sin(moonLon) - np.sin(obliquity) * np.sin(moonLat)
+    k = np.sin(obliquity) * np.cos(moonLat) * np.sin(moonLon) + np.cos(obliquity) * np.sin(moonLat)
+    moonRA = np.arctan2(m, l)
+    moonDec = np.arcsin(k)
+
+    lst = rad(280.46061837 + 360.98564736629 * n + longitude)
+    lat = rad(latitude)
+
+    def altitude(ra, dec):
+        return np.degrees(np.arcsin(np.sin(lat) * np.sin(dec) + np.cos(lat) * np.cos(dec) * np.cos(lst - ra)))
+
+    sunAlt = altitude(sunRA, sunDec)
+    moonAlt = altitude(moonRA, moonDec)
+    moonAlt = moonAlt - parallax * np.cos(rad(moonAlt))
+
+    return _refract(sunAlt), _refract(moonAlt)
+
+def sunAltAz(timestamp, latitude, longitude):
+    ''' Closed form refracted sun altitude and azimuth in degrees for a UTC unix timestamp '''
+    n = timestamp / 86400.0 - 10957.5
+    ra, dec = _sunEquatorial(n)
+    hourAngle = np.radians(280.46061837 + 360.98564736629 * n + longitude) - ra
+    lat = np.radians(latitude)
+    alt = np.degrees(np.arcsin(np.sin(lat) * np.sin(dec) + np.cos(lat) * np.cos(dec) * np.cos(hourAngle)))
+    az = np.degrees(np.arctan2(np.sin(hourAngle), np.cos(hourAngle) * np.sin(lat) - np.tan(dec) * np.cos(lat))) + 180.0
+
+    return float(_refract(alt)), float(az % 360.0)
+
+def _sunEquatorial(n):
+    # sun right ascension and declination in radians, n is the number of days since J2000.0
+    L = 280.460 + 0.9856474 * n
+    g = np.radians(357.528 + 0.9856003 * n)
+    sunLon = np.radians(L + 1.915 * np.sin(g) + 0.020 * np.sin(2 * g))
+    obliquity = np.radians(23.439 - 0.0000004 * n)
+    ra = np.arctan2(np.cos(obliquity) * np.sin(sunLon), np.cos(sunLon))
+    dec = np.arcsin(np.sin(obliquity) * np.sin(sunLon))
+
+    return ra, dec
+
+def _refract(alt, pressure=1010.0, temperature=15.0):
+    # true to apparent altitude with the same refraction model as ephem (libastro), solved by
+    # iterating apparent = true + r(apparent), r fades to zero about 8 degrees below the horizon
+    apparent = alt
+    for i in range(12):
+        x = np.clip(apparent, -9.0, 90.0)
+        low = ((2e-5 * x + 1.96e-2) * x + 1.594e-1) * pressure / ((273.0 + temperature) * ((8.45e-2 * x + 5.05e-1) * x + 1.0))
+        high = 0.00452 * pressure / ((273.0 + temperature) * np.tan(np.radians(np.maximum(x, 15.0))))
+        r = np.where(x >= 15.0, high, np.maximum(low, 0.0))
+        apparent = (apparent + alt + r) / 2.0
+
+    return apparent
+
+EVENT_HORIZONS = (
+    (-18.0, "DawnAstro", "DuskAstro"),
+    (-12.0, "DawnNauti", "DuskNauti"),
+    (-6.0, "DawnCivil", "DuskCivil"),
+    (0.0, "Sunrise", "Sunset")
+)
+
+EVENT_NAMES = [name for horizon in EVENT_HORIZONS for name in horizon[1:]] + ["Noon", "Midnight"]
+MOON_NAMES = ["MoonTransit", "MoonAntitransit", "Moonrise", "Moonset"]
+TABLE_COLUMNS = EVENT_NAMES + MOON_NAMES
+DAILY_VALUES = (
+    ("AS_MOON_TRANSIT", "MoonTransit"),
+    ("AS_MOON_ANTITRANSIT", "MoonAntitransit"),
+    ("AS_MOONRISE", "Moonrise"),
+    ("AS_MOONSET", "Moonset"),
+    ("AS_SUN_NOON", "Noon"),
+    ("AS_SUN_MIDNIGHT", "Midnight")
+)
+
+def _sunUpperLimb(timestamps, latitude, longitude):
+    # refracted altitude of the upper limb of the sun in degrees and its hour angle in radians
+    n = np.asarray(timestamps, dtype=np.float64) / 86400.0 - 10957.5
+    ra, dec = _sunEquatorial(n)
+    hourAngle = np.radians(280.46061837 + 360.98564736629 * n + longitude) - ra
+    lat = np.radians(latitude)
+    alt = np.degrees(np.arcsin(np.sin(lat) * np.sin(dec) + np.cos(lat) * np.cos(dec) * np.cos(hourAngle)))
+    g = np.radians(357.528 + 0.9856003 * n)
+    radius = 0.2666 / (1.00014 - 0.01671 * np.cos(g) - 0.00014 * np.cos(2 * g))
+
+    return _refract(alt) + radius, hourAngle
+
+def _falsePosition(function, t0, t1, f0, f1, iterations=8):
+    # Illinois false position on all the brackets [t0, t1] at once, f0 and f1 of opposite sign
+    t0, t1, f0, f1 = (np.array(values, dtype=np.float64) for values in (t0, t1, f0, f1))
+    for i in range(iterations):
+        flat = f1 == f0
+        t = np.where(flat, t1, t1 - f1 * (t1 - t0) / np.where(flat, 1.0, f1 - f0))
+        f = function(t)
+        keep = np.signbit(f) == np.signbit(f1)
+        t0, f0 = np.where(keep, t0, t1), np.where(keep, f0 / 2.0, f1)
+        t1, f1 = t, f
+
+    return t1
+
+def sunEvents(start, finish, latitude, longitude, step=600.0):
+    '''
+    All sun events between two UTC timestamps as sorted [timestamp, name] pairs, found in a single
+    pass over the sun sampled every step seconds. Transits and anti-transits are the zeros of the
+    hour angle, risings and settings the crossings of the upper limb through the EVENT_HORIZONS
+    altitudes, the same definitions as ephem. Every sign change between two samples is refined
+    with a few false position iterations, all the events together. The transits are added to the
+    samples so a sun only just clearing an altitude around noon or midnight is bracketed as well.
+    Events that do not happen, as in polar day or night, are never bracketed.
+    '''
+    times = np.arange(start, finish + step, step, dtype=np.float64)
+    upper, hourAngle = _sunUpperLimb(times, latitude, longitude)
+    events = []
+
+    sine = np.sin(hourAngle)
+    index = np.flatnonzero(np.signbit(sine[:-1]) != np.signbit(sine[1:]))
+    transits = _falsePosition(lambda t: np.sin(_sunUpperLimb(t, latitude, longitude)[1]), \
+        times[index], times[index + 1], sine[index], sine[index + 1])
+    for timestamp, noon in zip(transits, np.signbit(sine[index])):
+        events.append([float(timestamp), "Noon" if noon else "Midnight"])
+
+    order = np.argsort(np.concatenate((times, transits)), kind="stable")
+    times = np.concatenate((times, transits))[order]
+    upper = np.concatenate((upper, _sunUpperLimb(transits, latitude, longitude)[0]))[order]
+
+    levels = np.array([horizon for horizon, rising, setting in EVENT_HORIZONS])
+    above = upper[np.newaxis, :] - levels[:, np.newaxis]
+    level, index = np.nonzero(np.signbit(above[:, :-1]) != np.signbit(above[:, 1:]))
+    crossings = _falsePosition(lambda t: _sunUpperLimb(t, latitude, longitude)[0] - levels[level], \
+        times[index], times[index + 1], above[level, index], above[level, index + 1])
+    for timestamp, horizon, rising in zip(crossings, level, np.signbit(above[level, index])):
+        events.append([float(timestamp), EVENT_HORIZONS[horizon][1 if rising else 2]])
+
+    events = [event for event in events if start <= event[0] <= finish]
+    events.sort()
+    return events
+
+class eventCache():
+    '''
+    Sun and moon events for every UTC day of a year at the site. They only depend on the site
+    and the date so they are generated once into a compact binary table in the allsky tmp folder
+    which is then memory mapped. Row 0 holds the site and the year, row n the UTC timestamps of
+    the events of day n of the year, NaN when an event does not happen that day, so every query
+    is a row lookup. A table is only generated again when the latitude or longitude change.
+    '''
+
+    tableFile = "lightgraph_events_{}.npy"
+
+    def __init__(self, latitude, longitude):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.site = "{:.4f},{:.4f}".format(latitude, longitude)
+        self.tables = {}
+        self.path = s.getEnvironmentVariable("ALLSKY_TMP")
+
+    def _table(self, location, year):
+        if year not in self.tables:
+            table = None
+            fileName = None
+            if self.path is not None:
+                fileName = os.path.join(self.path, self.tableFile.format(year))
+                if os.path.exists(fileName):
+                    try:
+                        table = np.load(fileName, mmap_mode="r")
+                        if table.shape != (367, len(TABLE_COLUMNS)) or table[0, 0] != self.latitude or table[0, 1] != self.longitude:
+                            table = None
+                    except (OSError, ValueError) as e:
+                        s.log(1, "INFO: Ignoring unreadable light graph table {} - {}".format(fileName, e))
+                        table = None
+
+            if table is None:
+                s.log(1, "INFO: Generating light graph event table for {} at {}".format(year, self.site))
+                table = self._generate(location, year)
+                if fileName is not None:
+                    self._save(fileName, table, year)
 
-    border_color = light_color = dark_color = text_color =None
-    day2civil_color = civil2nauti_color = nauti2astro_color = None
-    elev_color = sun_solor = moon_color = None
-    latitude = longitude = 0
-    graph_X = graph_Y = graph_width = graph_height = 0
-    elev_X = elev_Y = elev_width = elev_height = 0
-    npoints = res = 0
-    startTime = finishTime = nowTime = datetime.datetime.now()
-    startTimeUTC = finishTimeUTC = nowTimeUTC = datetime.datetime.utcnow()
-    midnight = noon = None
-    location = None
-    timeArray = []
-    sunPath = moonPath = []
+            self.tables[year] = table
+
+        return self.tables[year]
+
+    def _save(self, fileName, table, year):
+        try:
+            _replaceFile(fileName, lambda file: np.save(file, table))
+        except OSError as e:
+            s.log(0, "ERROR: Unable to write light graph table {} - {}".format(fileName, e))
+
+        # tables from before last year are not needed any more, another process may remove them first
+        for oldYear in range(year - 10, year - 1):
+            oldFile = os.path.join(self.path, self.tableFile.format(oldYear))
+            try:
+                os.remove(oldFile)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                s.log(1, "INFO: Unable to remove old light graph table {} - {}".format(oldFile, e))
+
+    def _first(self, finder, body, dayStart, dayEnd):
+        try:
+            moment = finder(body(), start=dayStart)
+        except ephem.CircumpolarError:
+            return np.nan
+        if moment >= dayEnd:
+            return np.nan
+
+        return _timestamp(moment.datetime())
+
+    def _generate(self, location, year):
+        table = np.full((367, len(TABLE_COLUMNS)), np.nan)
+        table[0, :3] = [self.latitude, self.longitude, year]
+
+        # the sun events of the whole year in one pass, the first of each kind in a UTC day is kept
+        yearStart = _timestamp(datetime.datetime(year, 1, 1))
+        yearEnd = _timestamp(datetime.datetime(year + 1, 1, 1))
+        for timestamp, name in sunEvents(yearStart, yearEnd, self.latitude, self.longitude):
+            if timestamp < yearEnd:
+                row = table[_utcDatetime(timestamp).timetuple().tm_yday]
+                index = TABLE_COLUMNS.index(name)
+                if np.isnan(row[index]):
+                    row[index] = timestamp
+
+        day = datetime.date(year, 1, 1)
+        while day.year == year:
+            row = table[day.timetuple().tm_yday]
+            dayStart = ephem.Date(datetime.datetime(day.year, day.month, day.day))
+            dayEnd = ephem.Date(dayStart + 1)
+            for name, finder in (("MoonTransit", location.next_transit), \
+                    ("MoonAntitransit", location.next_antitransit), \
+                    ("Moonrise", location.next_rising), \
+                    ("Moonset", location.next_setting)):
+                row[TABLE_COLUMNS.index(name)] = self._first(finder, ephem.Moon, dayStart, dayEnd)
+            day = day + datetime.timedelta(days=1)
+
+        return table
+
+    def _row(self, location, day):
+        return self._table(location, day.year)[day.timetuple().tm_yday]
+
+    def daily(self, location, day):
+        '''
+        Returns the UTC timestamps, or None when they do not happen, of the next moon and sun
+        transits, moon rise and moon set after the local midnight starting the day.
+        '''
+        midnight = datetime.datetime(day.year, day.month, day.day).timestamp()
+        utcDay = _utcDatetime(midnight).date()
+        rows = [self._row(location, utcDay), self._row(location, utcDay + datetime.timedelta(days=1))]
+
+        values = {}
+        for name, column in DAILY_VALUES:
+            index = TABLE_COLUMNS.index(column)
+            found = [float(row[index]) for row in rows if row[index] >= midnight]
+            values[name] = min(found) if found else None
+
+        return values
+
+    def events(self, location, start, finish):
+        ''' Returns the sorted [timestamp, name] sun events between the two UTC timestamps '''
+        events = []
+        day = _utcDatetime(start).date()
+        while day <= _utcDatetime(finish).date():
+            row = self._row(location, day)
+            for index, name in enumerate(EVENT_NAMES):
+                if start <= row[index] <= finish:
+                    events.append([float(row[index]), name])
+            day = day + datetime.timedelta(days=1)
+
+        events.sort()
+        return events
+
+class eventWindow():
+    '''
+    The sun events inside the graph window, kept in preallocated arrays. When the window moves on
+    the events that fell out of it are dropped and only the new ones are appended.
+    '''
+
+    def __init__(self, capacity=64):
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.codes = np.zeros(capacity, dtype=np.int8)
+        self.count = 0
+        self.start = self.finish = None
+        self.site = None
+
+    def slide(self, cache, location, start, finish):
+        if self.site != cache.site or self.start is None or start < self.start or start >= self.finish \
+            or (finish - start) != (self.finish - self.start):
+            self.count = 0
+            new = cache.events(location, start, finish)
+        else:
+            drop = int(np.searchsorted(self.times[:self.count], start, side="left"))
+            keep = self.count - drop
+            self.times[:keep] = self.times[drop:self.count]
+            self.codes[:keep] = self.codes[drop:self.count]
+            self.count = keep
+            new = [event for event in cache.events(location, self.finish, finish) if event[0] > self.finish]
+
+        if self.count + len(new) > len(self.times):
+            size = 2 * (self.count + len(new))
+            self.times = np.resize(self.times, size)
+            self.codes = np.resize(self.codes, size)
+        for timestamp, name in new:
+            self.times[self.count] = timestamp
+            self.codes[self.count] = EVENT_NAMES.index(name)
+            self.count = self.count + 1
+
+        self.start = start
+        self.finish = finish
+        self.site = cache.site
+
+    def view(self):
+        return self.times[:self.count], self.codes[:self.count]
+
+# the chord between two samples h seconds apart is never more than PATH_ERROR_RATE * h degrees
+# off the sun or moon altitude, found over a year at sites from 34S to 78N including the sharp
+# turns at the zenith and the refraction bend just below the horizon
+PATH_ERROR_RATE = 2e-3
+
+class sampleWindow():
+    '''
+    Sun and moon altitudes on a time grid aligned to multiples of the sampling step, kept in
+    preallocated arrays with the window start and finish as first and last samples. Sliding the
+    window only evaluates the grid points that became visible.
+    '''
+
+    def __init__(self):
+        self.times = self.sunAlt = self.moonAlt = None
+        self.count = 0
+        self.step = None
+        self.site = None
+        self.start = self.finish = None
+
+    def slide(self, start, finish, step, latitude, longitude):
+        site = (latitude, longitude)
+        first = int(np.ceil(start / step))
+        last = int(np.floor(finish / step))
+        if self.site != site or self.step != step or self.start is None or start < self.start \
+            or start >= self.finish or (finish - start) != (self.finish - self.start):
+            capacity = int((finish - start) / step) + 4
+            self.times = np.zeros(capacity, dtype=np.float64)
+            self.sunAlt = np.zeros(capacity, dtype=np.float64)
+            self.moonAlt = np.zeros(capacity, dtype=np.float64)
+            self.count = 0
+            nextIndex = first
+        else:
+            grid = self.times[1:self.count + 1]
+            drop = int(np.searchsorted(grid, start, side="left"))
+            keep = self.count - drop
+            for values in (self.times, self.sunAlt, self.moonAlt):
+                values[1:keep + 1] = values[1 + drop:self.count + 1]
+            self.count = keep
+            nextIndex = max(first, int(round(grid[-1] / step)) + 1) if self.count > 0 else first
+
+        # the new grid points plus the two window ends are computed in a single call
+        newTimes = np.concatenate(([start], np.arange(nextIndex, last + 1) * step, [finish]))
+        sunAlt, moonAlt = sunMoonAltitude(newTimes, latitude, longitude)
+        added = len(newTimes) - 2
+        end = self.count + 1
+        self.times[end:end + added] = newTimes[1:-1]
+        self.sunAlt[end:end + added] = sunAlt[1:-1]
+        self.moonAlt[end:end + added] = moonAlt[1:-1]
+        self.count = self.count + added
+        for index, source in ((0, 0), (self.count + 1, -1)):
+            self.times[index] = newTimes[source]
+            self.sunAlt[index] = sunAlt[source]
+            self.moonAlt[index] = moonAlt[source]
+
+        self.site = site
+        self.step = step
+        self.start = start
+        self.finish = finish
+
+    def view(self):
+        end = self.count + 2
+        return self.times[:end], self.sunAlt[:end], self.moonAlt[:end]
+
+def _opaque(color):
+    return tuple(color) + (255,)
+
+def _composite(sprite, origin, alpha):
+    # the sprite colors are premultiplied by its alpha, the blend is done in place on the view of
+    # the image under the sprite so nothing frame sized is ever allocated
+    x, y = origin
+    roi = s.image[y:y + sprite.shape[0], x:x + sprite.shape[1]]
+    if roi.size == 0:
+        return
+    colors = sprite[:, :, :3]
+    cover = sprite[:, :, 3]
+    if roi.ndim == 2:
+        colors = cv2.cvtColor(colors, cv2.COLOR_BGR2GRAY)
+    else:
+        cover = cover[:, :, np.newaxis]
+
+    # pixels the sprite does not touch are skipped by working on its bounding rows only
+    rows = np.flatnonzero(sprite[:, :, 3].any(axis=1))
+    if rows.size == 0:
+        return
+    top, bottom = rows[0], rows[-1] + 1
+    roi = roi[top:bottom]
+    blended = roi * (1.0 - cover[top:bottom] * np.float32(alpha / 255.0)) + colors[top:bottom] * np.float32(alpha)
+    roi[:] = np.clip(blended + 0.5, 0, 255).astype(roi.dtype)
+
+class overlayCache():
+    '''
+    The rendered graph only changes once a minute. The last sprite is kept in memory and in the
+    allsky tmp folder along with the key it was rendered for, so the frames in between only have
+    to blend it into the image.
+    '''
+
+    cacheFile = "lightgraph_overlay.npz"
+
+    def __init__(self):
+        self.path = None
+        tmpPath = s.getEnvironmentVariable("ALLSKY_TMP")
+        if tmpPath is not None:
+            self.path = os.path.join(tmpPath, self.cacheFile)
+
+    def load(self, key):
+        ''' Returns the [(sprite, (x, y)), ...] layers stored for the key or None '''
+        if _overlayMemory.get("key") == key:
+            return _overlayMemory["layers"]
+
+        if self.path is not None and os.path.exists(self.path):
+            try:
+                with np.load(self.path) as data:
+                    if str(data["key"]) == key:
+                        layers = []
+                        for i in range(int(data["count"])):
+                            origin = data["origin{}".format(i)]
+                            layers.append((data["sprite{}".format(i)], (int(origin[0]), int(origin[1]))))
+                        self._remember(key, layers)
+                        return layers
+            except (OSError, ValueError, KeyError) as e:
+                s.log(1, "INFO: Ignoring unreadable light graph overlay {} - {}".format(self.path, e))
+
+        return None
+
+    def save(self, key, layers):
+        self._remember(key, layers)
+        if self.path is not None:
+            arrays = {"key": np.array(key), "count": np.array(len(layers))}
+            for i, (sprite, origin) in enumerate(layers):
+                arrays["sprite{}".format(i)] = sprite
+                arrays["origin{}".format(i)] = np.array(origin)
+            try:
+                _replaceFile(self.path, lambda file: np.savez(file, **arrays))
+            except OSError as e:
+                s.log(0, "ERROR: Unable to write light graph overlay {} - {}".format(self.path, e))
+
+    def _remember(self, key, layers):
+        _overlayMemory["key"] = key
+        _overlayMemory["layers"] = layers
+
+_overlayMemory = {}
+
+class glyphAtlas():
+    '''
+    The hour labels "00" to "23" rendered once with anti-aliasing for a font scale and color,
+    drawing a label is then a NumPy blend of the stored bitmap into the canvas instead of a
+    Hershey text render.
+    '''
+
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    pad = 2
+    atlases = {}
+
+    @classmethod
+    def get(cls, textSize, color):
+        key = (textSize, tuple(color))
+        if key not in cls.atlases:
+            cls.atlases[key] = cls(textSize, color)
+        return cls.atlases[key]
+
+    def __init__(self, textSize, color):
+        self.widths = []
+        self.ascents = []
+        self.glyphs = []
+        self.covers = []
+        for hour in range(24):
+            text = str(hour).zfill(2)
+            (width, height), baseline = cv2.getTextSize(text, self.font, textSize, 1)
+            mask = np.zeros((height + baseline + 2 * self.pad, width + 2 * self.pad), dtype=np.uint8)
+            cv2.putText(mask, text, (self.pad, self.pad + height), self.font, textSize, 255, 1, cv2.LINE_AA)
+            cover = mask.astype(np.float32)[:, :, np.newaxis] / 255.0
+            glyph = cover * np.array(_opaque(color), dtype=np.float32)
+            self.widths.append(width)
+            self.ascents.append(height)
+            self.glyphs.append(glyph)
+            self.covers.append(cover)
+
+    def blit(self, canvas, hour, x, y):
+        ''' Draws the hour label like cv2.putText would with its bottom left corner at x, y '''
+        glyph = self.glyphs[hour]
+        cover = self.covers[hour]
+        top = y - self.ascents[hour] - self.pad
+        left = x - self.pad
+        y0 = max(top, 0)
+        x0 = max(left, 0)
+        y1 = min(top + glyph.shape[0], canvas.shape[0])
+        x1 = min(left + glyph.shape[1], canvas.shape[1])
+        if y0 >= y1 or x0 >= x1:
+            return
+        region = canvas[y0:y1, x0:x1]
+        gy = slice(y0 - top, y1 - top)
+        gx = slice(x0 - left, x1 - left)
+        region[:] = np.clip(region * (1.0 - cover[gy, gx]) + glyph[gy, gx] + 0.5, 0, 255).astype(np.uint8)
+
+class lGraph():
+    '''
+    Draws the light graph. An instance can be kept and updated frame after frame, the events and
+    the elevation samples then only slide along with the 24 hour window.
+    '''
 
     def _readColor(self, input):
         return tuple(int(item) for item in input.split(' '))
@@ -320,8 +907,9 @@ class lGraph():
         self.civil2nauti_color = self._scaleColor(self.light_color, self.dark_color, 0.50)
         self.nauti2astro_color = self._scaleColor(self.light_color, self.dark_color, 0.25)
 
-        self.latitude = s.convertLatLon(s.getSetting("latitude"))
-        self.longitude = s.convertLatLon(s.getSetting("longitude"))
+        # the offline renderer can pass the site in the parameters, otherwise it comes from the settings
+        self.latitude = s.convertLatLon(params.get("latitude", s.getSetting("latitude")))
+        self.longitude = s.convertLatLon(params.get("longitude", s.getSetting("longitude")))
 
         if params["draw_elev"] == True:
             self.elev_color = self._readColor(params["elev_color"])
@@ -401,401 +989,527 @@ class lGraph():
 
         return res
 
-    def calculations(self, debug, params):
+    def set_location(self, debug, params):
         self.location = ephem.Observer()
         self.location.lat = self._convertLatLon(self.latitude)
         self.location.lon = self._convertLatLon(self.longitude)
         self.location.date = ephem.Date(self.nowTimeUTC)
 
-        ss = ephem.Sun()
+    def _checkEvents(self):
+        if self.events is None or (self.events.latitude, self.events.longitude) != (self.latitude, self.longitude):
+            self.events = eventCache(self.latitude, self.longitude)
 
-        # store in an array all next risings and settings, and transits
-        self.location.horizon ='-18:0'
-        try:
-            raise_astro1 = self.location.next_rising(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(raise_astro1, "DawnAstro")]
-        except:
-            pass
-        try:
-            set_astro1 = self.location.next_setting(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(set_astro1, "DuskAstro")]
-        except:
-            pass
-        self.location.horizon ='-12:0'
-        try:
-            raise_nauti1 = self.location.next_rising(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(raise_nauti1, "DawnNauti")]
-        except:
-            pass
-        try:
-            set_nauti1 = self.location.next_setting(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(set_nauti1, "DuskNauti")]
-        except:
-            pass
-        self.location.horizon ='-6:0'
-        try:
-            raise_civil1 = self.location.next_rising(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(raise_civil1, "DawnCivil")]
-        except:
-            pass
-        try:
-            set_civil1 = self.location.next_setting(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(set_civil1, "DuskCivil")]
-        except:
-            pass
-        self.location.horizon ='0:0'
-        try:
-            raise1 = self.location.next_rising(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(raise1, "Sunrise")]
-        except:
-            pass
-        try:
-            set1 = self.location.next_setting(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(set1, "Sunset")]
-        except:
-            pass
+    def calculations(self, debug, params):
+        # all risings, settings and transits inside the graph window, sorted
+        self._checkEvents()
+        start = _timestamp(self.startTimeUTC)
+        finish = _timestamp(self.finishTimeUTC)
+        self.window.slide(self.events, self.location, start, finish)
+        times, codes = self.window.view()
 
-        try:
-            transit1 = self.location.next_transit(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(transit1, "Noon")]
-        except:
-            pass
-        try:
-            anti_transit1 = self.location.next_antitransit(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(anti_transit1, "Midnight")]
-        except:
-            pass
-        
-        # of centered, add all previous risings and settings and transits
-        if params["now_point"] == "Center":
-            self.location.horizon ='-18:0'
-            try:
-                raise_astro2 = self.location.previous_rising(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(raise_astro2, "DawnAstro")]
-            except:
-                pass
-            try:
-                set_astro2 = self.location.previous_setting(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(set_astro2, "DuskAstro")]
-            except:
-                pass
-            self.location.horizon ='-12:0'
-            try:
-                raise_nauti2 = self.location.previous_rising(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(raise_nauti2, "DawnNauti")]
-            except:
-                pass
-            try:
-                set_nauti2 = self.location.previous_setting(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(set_nauti2, "DuskNauti")]
-            except:
-                pass
-            self.location.horizon ='-6:0'
-            try:
-                raise_civil2 = self.location.previous_rising(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(raise_civil2, "DawnCivil")]
-            except:
-                pass
-            try:
-                set_civil2 = self.location.previous_setting(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(set_civil2, "DuskCivil")]
-            except:
-                pass
-            self.location.horizon ='0:0'
-            try:
-                raise2 = self.location.previous_rising(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(raise2, "Sunrise")]
-            except:
-                pass
-            try:
-                set2 = self.location.previous_setting(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(set2, "Sunset")]
-            except:
-                pass
+        # the transits do not trigger a color change, but draw a single line
+        self.noon = self.midnight = None
+        for timestamp, code in zip(times, codes):
+            moment = (_utcDatetime(timestamp), EVENT_NAMES[code], int((timestamp - start) / (finish - start) * self.graph_width))
+            if moment[1] == "Noon":
+                self.noon = moment
+            elif moment[1] == "Midnight":
+                self.midnight = moment
 
-            try:
-                transit2 = self.location.previous_transit(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(transit2, "Noon")]
-            except:
-                pass
-            try:
-                anti_transit2 = self.location.previous_antitransit(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(anti_transit2, "Midnight")]
-            except:
-                pass
+    def calSunMoon(self, params):
+        start = _timestamp(self.startTimeUTC)
+        finish = _timestamp(self.finishTimeUTC)
+        # the widest grid keeping the paths within elev_error pixels, but not finer than a pixel column
+        error = float(params.get("elev_error", 0.5))
+        scale = self.elev_height / 180.0
+        step = max(error / (scale * PATH_ERROR_RATE), 24.0 * 3600.0 / self.elev_width)
+        self.samples.slide(start, finish, step, self.latitude, self.longitude)
+        times, sunAlt, moonAlt = self.samples.view()
+        self.pathX = ((times - start) / (finish - start) * self.elev_width).astype(int)
+        self.sunPath = (sunAlt / 90.0 * self.elev_height / 2.0).astype(int)
+        self.moonPath = (moonAlt / 90.0 * self.elev_height / 2.0).astype(int)
 
-        # sort all events
-        self.timeArray.sort()
+        # chart coordinates as int32 point runs ready for cv2.polylines
+        below = params.get("elev_below", True) == True
+        self.sunPoints = self._pathRuns(self.sunPath, below)
+        self.moonPoints = self._pathRuns(self.moonPath, below)
 
-        # filter out events before start time or after end time
-        while (self.timeArray[0])[0] < self.startTimeUTC:
-            self.timeArray = self.timeArray[1:]
+    def _pathRuns(self, path, below):
+        points = np.empty((len(path), 2), dtype=np.int32)
+        points[:, 0] = self.pathX
+        points[:, 1] = int(self.elev_height / 2.0) - path
+        if below:
+            return [points]
 
-        while (self.timeArray[-1])[0] > self.finishTimeUTC:
-            self.timeArray = self.timeArray[:-1]
+        # only keep the segments with at least one end above the horizon, split into runs
+        keep = (path[:-1] >= 0) | (path[1:] >= 0)
+        edges = np.diff(np.concatenate(([0], keep.astype(np.int8), [0])))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+        return [points[first:last + 1] for first, last in zip(starts, ends)]
 
-        # add start and end time events
-        self.timeArray = [(self.startTimeUTC, "Start")] + self.timeArray + [(self.finishTimeUTC, "Finish")]
+    def _bandColors(self, params):
+        # one sun altitude per pixel column of the graph, mapped through the twilight palette
+        columns = self.graph_width + 1
+        span = (self.finishTimeUTC - self.startTimeUTC).total_seconds()
+        times = _timestamp(self.startTimeUTC) + np.arange(columns) * (span / self.graph_width)
+        sunAlt, moonAlt = sunMoonAltitude(times, self.latitude, self.longitude)
 
-        ss = ephem.Sun()
-        ss.compute(self.location)
-        sun_elev = ss.alt
+        palette = np.array([self.dark_color, self.nauti2astro_color, self.civil2nauti_color, \
+            self.day2civil_color, self.light_color], dtype=np.float64)
+        if params.get("band_gradient", False) == True:
+            # each twilight color sits at the middle of its phase and blends into the next one
+            anchors = [-18.0, -15.0, -9.0, -3.0, 0.0]
+            colors = np.stack([np.interp(sunAlt, anchors, palette[:, c]) for c in range(palette.shape[1])], axis=1)
+        else:
+            colors = palette[np.digitize(sunAlt, [-18.0, -12.0, -6.0, 0.0])]
 
-        # add to each element datetime scaled to rectangle X coordinate
-        for i in range(len(self.timeArray)):
-            self.timeArray[i] = self.timeArray[i] + (int((self.timeArray[i][0] - self.startTimeUTC).total_seconds() / (self.finishTimeUTC - self.startTimeUTC).total_seconds() * self.graph_width),)
+        return colors.astype(np.uint8)
 
-        # remove and store separately the transits as the do not trigger a color change, but draw a single line
-        for moment in self.timeArray:
-            if moment[1] == "Noon":
-                self.noon = moment
-                self.timeArray.remove(moment)
-            if moment[1] == "Midnight":
-                self.midnight = moment
-                self.timeArray.remove(moment)
-        for moment in self.timeArray: # not sure yey if an extra check is really necessary, probably not
-            if moment[1] == "Noon":
-                self.noon = moment
-                self.timeArray.remove(moment)
-            if moment[1] == "Midnight":
-                self.midnight = moment
-                self.timeArray.remove(moment)     
+    def _barBounds(self, params):
+        # image rectangle of the light bar with its tick labels, with room for the now marks and thick borders
+        margin = 6
+        x0 = self.graph_X - margin
+        x1 = self.graph_X + self.graph_width + margin
+        y0 = self.graph_Y - margin
+        y1 = self.graph_Y + self.graph_height + margin
+        if params["hour_ticks"] == True:
+            tickSize = int(self.graph_height / 5)
+            y0 = self.graph_Y - tickSize - margin
+            if params["hour_nums"] == True:
+                textSz = cv2.getTextSize("00", cv2.FONT_HERSHEY_SIMPLEX, float(params["hour_txt_size"]), 1)[0]
+                x0 = self.graph_X - int(textSz[0] / 2.0) - margin
+                x1 = self.graph_X + self.graph_width + int(textSz[0] / 2.0) + margin
+                y0 = self.graph_Y - tickSize - textSz[1] - margin
 
-    def calSunMoon(self, params):
-        k = 3 # k is the precission for moon-solar plot in pixels
-        self.npoints = int(self.elev_width / k) + 1
-        self.res = self.elev_width / self.npoints
-        delta_t = 24.0 * 3600.0 / self.npoints
-        sun = ephem.Sun()
-        moon = ephem.Moon()
-        for x in range(self.npoints + 1):
-            xt = self.startTimeUTC + datetime.timedelta(seconds=x * delta_t)
-            self.location.date = ephem.Date(xt)
-            sun.compute(self.location)
-            self.sunPath = self.sunPath + [(x * self.res, int(degrees(sun.alt) / 90.0 * self.elev_height / 2.0))]
-            moon.compute(self.location)
-            self.moonPath = self.moonPath + [(x * self.res, int(degrees(moon.alt) / 90.0 * self.elev_height / 2.0))]
-
-    def _azMidDarkness(self, dt1, dt2):
-        tdelta = (dt2 - dt1).total_seconds()
-        tmid = dt1 + datetime.timedelta(seconds=tdelta/2)
-        loc = self.location
-        loc.date = ephem.Date(tmid.strftime("%Y/%m/%d %H:%M:%S"))
-        sun = ephem.Sun()
-        sun.compute(loc)
-        a = degrees(sun.alt)
-        if a < -18.0:
-            drk = 0 # night
-        elif a < -12.0:
-            drk = 1 # astronomical
-        elif a < -6.0:
-            drk = 2 # nautical
-        elif a < 0.0:
-            drk = 3 # civil
-        else:
-            drk = 4 # day
+        return self._clipBounds(x0, y0, x1, y1)
 
-        return drk
+    def _elevBounds(self, params):
+        margin = 2
+        return self._clipBounds(self.elev_X - margin, self.elev_Y - margin, \
+            self.elev_X + self.elev_width + margin, self.elev_Y + self.elev_height + margin)
 
-    def draw (self, params):
-        alpha = float(params["alpha"])
+    def _clipBounds(self, x0, y0, x1, y1):
+        return max(x0, 0), max(y0, 0), min(x1, self.image_width), min(y1, self.image_height)
+
+    def render(self, params):
+        '''
+        Draws the light bar and the elevation chart into separate transparent BGRA sprites, so
+        that only the areas they cover have to be blended. Returns a list of (sprite, (x, y)).
+        '''
+        layers = []
+        x0, y0, x1, y1 = self._barBounds(params)
+        sprite = np.zeros((y1 - y0, x1 - x0, 4), dtype=np.uint8)
+        self._paintBar(sprite, x0, y0, params)
+        layers.append((sprite, (x0, y0)))
+
+        if params["draw_elev"] == True:
+            x0, y0, x1, y1 = self._elevBounds(params)
+            sprite = np.zeros((y1 - y0, x1 - x0, 4), dtype=np.uint8)
+            self._paintElev(sprite, x0, y0, params)
+            layers.append((sprite, (x0, y0)))
+
+        return layers
+
+    def _paintBar(self, canvas, ox, oy, params):
         textSize = float(params["hour_txt_size"])
-        
-        canvas = s.image
-        if alpha < 1.0:
-            canvas = s.image.copy() # if transparency, work on a copy
-        else:
-            canvas = s.image
-
-        # dark areas
-        for i in range(len(self.timeArray)-1):
-            # print (self._timeArray[i][0].strftime("%Y-%m-%d %H:%M:%S"), " to ",self._timeArray[i+1][0].strftime("%Y-%m-%d %H:%M:%S"), "(", self._timeArray[i][1], " to ",self._timeArray[i+1][1])
-            drk = self._azMidDarkness(self.timeArray[i][0], self.timeArray[i + 1][0])
-            if drk == 0:
-                col = self.dark_color
-            elif drk == 1:
-                col = self.nauti2astro_color
-            elif drk == 2:
-                col = self.civil2nauti_color
-            elif drk == 3:
-                col = self.day2civil_color
-            else:
-                col = self.light_color
 
-            cv2.rectangle(img=canvas, \
-                pt1=(self.graph_X + self.timeArray[i][2], self.graph_Y), \
-                pt2=(self.graph_X + self.timeArray[i + 1][2], self.graph_Y + self.graph_height), \
-                color=col, thickness=cv2.FILLED)
+        # everything is drawn relative to the sprite origin, colors are opaque
+        gX = self.graph_X - ox
+        gY = self.graph_Y - oy
+        border_color = _opaque(self.border_color)
+        light_color = _opaque(self.light_color)
+        dark_color = _opaque(self.dark_color)
+
+        # dark areas, the whole band is written in one go
+        band = canvas[gY:gY + self.graph_height + 1, gX:gX + self.graph_width + 1]
+        band[:, :, :3] = self._bandColors(params)[np.newaxis, :band.shape[1]]
+        band[:, :, 3] = 255
 
         # transits
         if self.noon:
-            cv2.line(img=canvas, pt1=(self.graph_X + self.noon[2], self.graph_Y), \
-                pt2=(self.graph_X + self.noon[2], self.graph_Y + self.graph_height), color=self.dark_color)
+            cv2.line(img=canvas, pt1=(gX + self.noon[2], gY), \
+                pt2=(gX + self.noon[2], gY + self.graph_height), color=dark_color)
 
         if self.midnight:
-            cv2.line(img=canvas, pt1=(self.graph_X + self.midnight[2], self.graph_Y), \
-                pt2=(self.graph_X + self.midnight[2], self.graph_Y + self.graph_height), color=self.light_color)
+            cv2.line(img=canvas, pt1=(gX + self.midnight[2], gY), \
+                pt2=(gX + self.midnight[2], gY + self.graph_height), color=light_color)
 
         # box
-        cv2.rectangle(img=canvas, pt1=(self.graph_X, self.graph_Y), \
-            pt2=(self.graph_X + self.graph_width, self.graph_Y + self.graph_height), \
-            thickness=2, color=self.border_color)    
+        cv2.rectangle(img=canvas, pt1=(gX, gY), \
+            pt2=(gX + self.graph_width, gY + self.graph_height), \
+            thickness=2, color=border_color)
 
         # hour ticks
         if params["hour_ticks"] == True:
             tickSize = int(self.graph_height / 5)
             firstIntHourTime = self.startTime.replace(second=0, minute=0, microsecond=0) # everything is calculated in UTC, but this is local
-            startingX = -(self.startTime - firstIntHourTime).total_seconds() / 3600.0 / 24.0 * self.graph_width + self.graph_X
+            startingX = -(self.startTime - firstIntHourTime).total_seconds() / 3600.0 / 24.0 * self.graph_width + gX
             hourdeltaPx = self.graph_width / 24.0
 
-            yy = self.graph_Y
-            font = cv2.FONT_HERSHEY_SIMPLEX
+            glyphs = glyphAtlas.get(textSize, self.text_color)
             onlyHour = firstIntHourTime.hour
-            skipHour = False               
+            skipHour = False
             for i in range(26):
                 xPos = int(startingX + i * hourdeltaPx)
-                if xPos > self.graph_X and xPos < self.graph_X + self.graph_width:
-                    cv2.line(img=canvas, pt1=(xPos, self.graph_Y), pt2=(xPos, self.graph_Y - tickSize), thickness=2, color=self.border_color)
+                if xPos > gX and xPos < gX + self.graph_width:
+                    cv2.line(img=canvas, pt1=(xPos, gY), pt2=(xPos, gY - tickSize), thickness=2, color=border_color)
                     if params["hour_nums"] == True:
-                        textSz = cv2.getTextSize(str(onlyHour).zfill(2), font, textSize, 1)[0]
-                        textX = xPos - int(textSz[0] / 2.0)
+                        textWidth = glyphs.widths[onlyHour]
+                        textX = xPos - int(textWidth / 2.0)
                         if skipHour:
                             skipHour = False
-                        elif textSz[0] > hourdeltaPx:
+                        elif textWidth > hourdeltaPx:
                             skipHour = True
                         if not skipHour:
-                            cv2.putText(canvas, str(onlyHour).zfill(2), (textX, self.graph_Y - tickSize - 1), font, textSize, self.text_color, 1, cv2.LINE_AA)
+                            glyphs.blit(canvas, onlyHour, textX, gY - tickSize - 1)
                 onlyHour = onlyHour + 1
                 if onlyHour == 24:
                     onlyHour = 0
 
         # now mark
         if params["now_point"] == "Center":
-            startingX = int(self.graph_X + self.graph_width / 2.0)
+            startingX = int(gX + self.graph_width / 2.0)
         else:
-            startingX = self.graph_X
-        
-        tri = np.array([[startingX, self.graph_Y + 8], [startingX - 5, self.graph_Y], [startingX + 5, self.graph_Y]])
-        cv2.fillPoly(img=canvas, pts=[tri], color=self.border_color)
-        tri = np.array([[startingX, self.graph_Y + self.graph_height - 8], [startingX - 5, self.graph_Y + self.graph_height], [startingX + 5, self.graph_Y + self.graph_height]])
-        cv2.fillPoly(img=canvas, pts=[tri], color=self.border_color)
+            startingX = gX
 
-        #elev chart
-        if params["draw_elev"] == True:
-            # box
-            cv2.rectangle(img=canvas, pt1=(self.elev_X, self.elev_Y), \
-                pt2=(self.elev_X + self.elev_width, self.elev_Y + self.elev_height), \
-                thickness=1, color=self.elev_color)
-            cv2.line(img=canvas, pt1=(self.elev_X, self.elev_Y + int(self.elev_height / 2)), \
-                                pt2=(self.elev_X + self.elev_width, self.elev_Y + int(self.elev_height / 2)), thickness=2, color=self.elev_color)
-            TROPIC = 23.5
-            POLAR = 66.5
-            cv2.line(img=canvas, pt1=(self.elev_X, self.elev_Y + int(self.elev_height / 2 - POLAR * self.elev_height / 180.0)), \
-                                pt2=(self.elev_X + self.elev_width, self.elev_Y + int(self.elev_height / 2 - POLAR * self.elev_height / 180.0)), thickness=1, color=self.elev_color)
-            cv2.line(img=canvas, pt1=(self.elev_X, self.elev_Y + int(self.elev_height / 2 - TROPIC * self.elev_height / 180.0)), \
-                                pt2=(self.elev_X + self.elev_width, self.elev_Y + int(self.elev_height / 2 - TROPIC * self.elev_height / 180.0)), thickness=1, color=self.elev_color)
-            cv2.line(img=canvas, pt1=(self.elev_X, self.elev_Y + int(self.elev_height / 2 + POLAR * self.elev_height / 180.0)), \
-                                pt2=(self.elev_X + self.elev_width, self.elev_Y + int(self.elev_height / 2 + POLAR * self.elev_height / 180.0)), thickness=1, color=self.elev_color)
-            cv2.line(img=canvas, pt1=(self.elev_X, self.elev_Y + int(self.elev_height / 2 + TROPIC * self.elev_height / 180.0)), \
-                                pt2=(self.elev_X + self.elev_width, self.elev_Y + int(self.elev_height / 2 + TROPIC * self.elev_height / 180.0)), thickness=1, color=self.elev_color)
-            
-            # hours
-            startingX = (firstIntHourTime - self.startTime).total_seconds() / 3600.0 / 24.0 * self.elev_width + self.elev_X
-            hourdeltaPx = self.elev_width / 24.0
-            yy = self.elev_Y
-            onlyHour = firstIntHourTime.hour               
-            for i in range(25):
-                xPos = int(startingX + i * hourdeltaPx)
-                if xPos > self.elev_X and xPos < self.elev_X + self.elev_width:
-                    cv2.line(img=canvas, pt1=(xPos, self.elev_Y), pt2=(xPos, self.elev_Y + self.elev_height), thickness=1, color=self.elev_color)
-                onlyHour = onlyHour + 1
-                if onlyHour == 24:
-                    onlyHour = 0
+        tri = np.array([[startingX, gY + 8], [startingX - 5, gY], [startingX + 5, gY]])
+        cv2.fillPoly(img=canvas, pts=[tri], color=border_color)
+        tri = np.array([[startingX, gY + self.graph_height - 8], [startingX - 5, gY + self.graph_height], [startingX + 5, gY + self.graph_height]])
+        cv2.fillPoly(img=canvas, pts=[tri], color=border_color)
 
-            # mark
-            if params["now_point"] == "Center":
-                startingX = self.elev_X+ int(self.elev_width / 2)
-            else:
-                startingX = self.elev_X 
-            cv2.line(img=canvas, pt1=(startingX, self.elev_Y), pt2=(startingX, self.elev_Y + self.elev_height), thickness=2, color=self.elev_color)
-
-            # paths
-            for i in range(len(self.sunPath) - 1):
-                cv2.line(img=canvas, \
-                    pt1=(self.elev_X + int(i * self.res), \
-                        self.elev_Y + int(self.elev_height / 2.0) - self.sunPath[i][1]), \
-                    pt2=(self.elev_X + int((i + 1) * self.res), \
-                        self.elev_Y + int(self.elev_height / 2.0) - self.sunPath[i + 1][1]), \
-                    thickness=1, color=self.sun_color)
-                cv2.line(img=canvas, \
-                    pt1=(self.elev_X + int(i * self.res), \
-                        self.elev_Y + int(self.elev_height / 2.0) - self.moonPath[i][1]), \
-                    pt2=(self.elev_X + int((i + 1) * self.res), \
-                        self.elev_Y + int(self.elev_height / 2.0) - self.moonPath[i + 1][1]), \
-                    thickness=1, color=self.moon_color)
-
-        if alpha < 1.0:
-            tmpcanv = cv2.addWeighted(canvas, alpha, s.image, 1 - alpha, 0)
-            s.image = tmpcanv
+    def _paintElev(self, canvas, ox, oy, params):
+        eX = self.elev_X - ox
+        eY = self.elev_Y - oy
+        elev_color = _opaque(self.elev_color)
+        sun_color = _opaque(self.sun_color)
+        moon_color = _opaque(self.moon_color)
+        firstIntHourTime = self.startTime.replace(second=0, minute=0, microsecond=0)
+
+        # box
+        cv2.rectangle(img=canvas, pt1=(eX, eY), \
+            pt2=(eX + self.elev_width, eY + self.elev_height), \
+            thickness=1, color=elev_color)
+        cv2.line(img=canvas, pt1=(eX, eY + int(self.elev_height / 2)), \
+                            pt2=(eX + self.elev_width, eY + int(self.elev_height / 2)), thickness=2, color=elev_color)
+        TROPIC = 23.5
+        POLAR = 66.5
+        cv2.line(img=canvas, pt1=(eX, eY + int(self.elev_height / 2 - POLAR * self.elev_height / 180.0)), \
+                            pt2=(eX + self.elev_width, eY + int(self.elev_height / 2 - POLAR * self.elev_height / 180.0)), thickness=1, color=elev_color)
+        cv2.line(img=canvas, pt1=(eX, eY + int(self.elev_height / 2 - TROPIC * self.elev_height / 180.0)), \
+                            pt2=(eX + self.elev_width, eY + int(self.elev_height / 2 - TROPIC * self.elev_height / 180.0)), thickness=1, color=elev_color)
+        cv2.line(img=canvas, pt1=(eX, eY + int(self.elev_height / 2 + POLAR * self.elev_height / 180.0)), \
+                            pt2=(eX + self.elev_width, eY + int(self.elev_height / 2 + POLAR * self.elev_height / 180.0)), thickness=1, color=elev_color)
+        cv2.line(img=canvas, pt1=(eX, eY + int(self.elev_height / 2 + TROPIC * self.elev_height / 180.0)), \
+                            pt2=(eX + self.elev_width, eY + int(self.elev_height / 2 + TROPIC * self.elev_height / 180.0)), thickness=1, color=elev_color)
+
+        # hours
+        startingX = (firstIntHourTime - self.startTime).total_seconds() / 3600.0 / 24.0 * self.elev_width + eX
+        hourdeltaPx = self.elev_width / 24.0
+        for i in range(25):
+            xPos = int(startingX + i * hourdeltaPx)
+            if xPos > eX and xPos < eX + self.elev_width:
+                cv2.line(img=canvas, pt1=(xPos, eY), pt2=(xPos, eY + self.elev_height), thickness=1, color=elev_color)
+
+        # mark
+        if params["now_point"] == "Center":
+            startingX = eX + int(self.elev_width / 2)
         else:
-            s.image = canvas
+            startingX = eX
+        cv2.line(img=canvas, pt1=(startingX, eY), pt2=(startingX, eY + self.elev_height), thickness=2, color=elev_color)
 
-    def exportData(self):
-        # this is temporary until allsky exports all relevant datetimes
-        sun = ephem.Sun()
+        # paths, one polyline call per body
+        cv2.polylines(canvas, [points + (eX, eY) for points in self.sunPoints], False, sun_color, 1)
+        cv2.polylines(canvas, [points + (eX, eY) for points in self.moonPoints], False, moon_color, 1)
 
-        t = datetime.datetime.utcnow()
-        self.location.horizon = 0
+    def _overlayKey(self, params):
+        # the graph moves once a minute, anything else that changes it is a parameter, the site or the image size
+        return json.dumps([self.nowTime.strftime("%Y%m%d%H%M"), self.latitude, self.longitude, \
+            s.image.shape, params], sort_keys=True, default=str)
 
-        self.location.date = ephem.Date(t)
+    def _timed(self, phase, function, *args):
+        # runs function and adds its time in ms to the phase
+        started = time.perf_counter()
+        result = function(*args)
+        self.timings[phase] = self.timings[phase] + (time.perf_counter() - started) * 1000.0
 
-        sun.compute(self.location)
-        sun_alt = "{:.3f}".format(degrees(sun.alt))
-        sun_az = "{:.3f}".format(degrees(sun.az))
+        return result
 
-        self.location.date = ephem.Date(self.startTime)
+    def draw (self, params):
+        alpha = float(params["alpha"])
 
-        moon = ephem.Moon()
-        moon.compute(self.location)
-        moon_trans = ephem.localtime(self.location.next_transit(ephem.Moon())).time().strftime("%H:%M")
-        moon_atran = ephem.localtime(self.location.next_antitransit(ephem.Moon())).time().strftime("%H:%M")
-        moon_rise = ephem.localtime(self.location.next_rising(ephem.Moon())).time().strftime("%H:%M")
-        moon_set = ephem.localtime(self.location.next_setting(ephem.Moon())).time().strftime("%H:%M")
-        
-        sun.compute(self.location)
-        sun_trans = ephem.localtime(self.location.next_transit(ephem.Sun())).time().strftime("%H:%M")
-        sun_atran = ephem.localtime(self.location.next_antitransit(ephem.Sun())).time().strftime("%H:%M")
-        
-        #age = moon.age()
+        overlay = overlayCache()
+        key = self._overlayKey(params)
+        layers = overlay.load(key)
+        if layers is None:
+            self._timed("CALC", self.calculations, self.debug, params)
+            if params["draw_elev"] == True:
+                self._timed("SUNMOON", self.calSunMoon, params)
+            layers = self.render(params)
+            overlay.save(key, layers)
 
-        os.environ["AS_SUN_ALT"] = str(sun_alt)
-        os.environ["AS_SUN_AZ"] = str(sun_az)
+        for sprite, origin in layers:
+            _composite(sprite, origin, alpha)
 
-        os.environ["AS_MOON_TRANSIT"] = str(moon_trans)
-        os.environ["AS_MOON_ANTITRANSIT"] = str(moon_atran)
-        os.environ["AS_MOONRISE"] = str(moon_rise)
-        os.environ["AS_MOONSET"] = str(moon_set)
+    def exportData(self):
+        # this is temporary until allsky exports all relevant datetimes
+        sunAlt, sunAz = sunAltAz(_timestamp(self.nowTimeUTC), self.latitude, self.longitude)
+        os.environ["AS_SUN_ALT"] = "{:.3f}".format(sunAlt)
+        os.environ["AS_SUN_AZ"] = "{:.3f}".format(sunAz)
 
-        os.environ["AS_SUN_NOON"] = str(sun_trans)
-        os.environ["AS_SUN_MIDNIGHT"] = str(sun_atran)
+        # the transits, rises and sets only change once a day
+        self._checkEvents()
+        daily = self.events.daily(self.location, self.nowTime.date())
+        for name, timestamp in daily.items():
+            if timestamp is None:
+                os.environ[name] = "--:--"
+            else:
+                os.environ[name] = datetime.datetime.fromtimestamp(timestamp).strftime("%H:%M")
 
+    def __init__(self, debug, params, nowUTC=None):
+        self.noon = self.midnight = None
+        self.location = None
+        self.events = None
+        self.window = eventWindow()
+        self.samples = sampleWindow()
+        self.pathX = self.sunPath = self.moonPath = None
+        self.sunPoints = self.moonPoints = []
+        self.update(debug, params, nowUTC)
 
-    def __init__(self, debug, params):
+    def update(self, debug, params, nowUTC=None):
+        ''' Moves the graph to nowUTC, a naive UTC datetime, or to the current time '''
+        started = time.perf_counter()
+        self.timings = dict.fromkeys(TIMING_PHASES, 0.0)
+        self.debug = debug
+        if nowUTC is None:
+            nowUTC = datetime.datetime.utcnow()
+        self.nowTimeUTC = nowUTC
+        self.nowTime = datetime.datetime.fromtimestamp(_timestamp(nowUTC))
         self.get_params(debug, params)
         self.set_size(debug, params)
         self.set_time(debug, params)
-        self.calculations(debug, params)
-        if params["draw_elev"] == True:
-            self.calSunMoon(params)
+        self.set_location(debug, params)
+        self.timings["PARAMS"] = (time.perf_counter() - started) * 1000.0
+
+_drawer = None
+
+TIMING_PHASES = ("PARAMS", "CALC", "SUNMOON", "EXPORT", "DRAW")
+TIMING_FILE = "allskylightgraph.json"
+TIMING_HISTORY = "lightgraph_timings.npy"
+
+def _timingHistory(timings, frames):
+    '''
+    Adds the timings to the last frames timings kept in a small NumPy file in the allsky tmp
+    folder, one row per image, and returns them. Only this image is used if there is no tmp folder
+    '''
+    row = np.array([list(timings.values())], dtype=np.float32)
+    tmpPath = s.getEnvironmentVariable("ALLSKY_TMP")
+    if tmpPath is None:
+        return row
+
+    fileName = os.path.join(tmpPath, TIMING_HISTORY)
+    history = row
+    if os.path.exists(fileName):
+        try:
+            previous = np.load(fileName)
+            if previous.ndim == 2 and previous.shape[1] == row.shape[1]:
+                history = np.concatenate((previous, row))[-frames:]
+        except (OSError, ValueError) as e:
+            s.log(1, "INFO: Ignoring unreadable light graph timings {} - {}".format(fileName, e))
+
+    try:
+        _replaceFile(fileName, lambda file: np.save(file, history))
+    except OSError as e:
+        s.log(0, "ERROR: Unable to write light graph timings {} - {}".format(fileName, e))
+
+    return history
+
+def publishTimings(timings, frames):
+    '''
+    Saves the phase timings of this image in ms as extra data, AS_LIGHTGRAPH_MS_<PHASE>, together
+    with their median and 95th percentile over the last frames images. Zero frames disables this.
+    '''
+    timings = dict(timings)
+    timings["TOTAL"] = sum(timings.values())
+    if frames <= 0:
+        return timings
+
+    history = _timingHistory(timings, frames)
+    p50 = np.percentile(history, 50, axis=0)
+    p95 = np.percentile(history, 95, axis=0)
+
+    extraData = {}
+    for i, (phase, value) in enumerate(timings.items()):
+        name = "AS_LIGHTGRAPH_MS_" + phase
+        extraData[name] = "{:.1f}".format(value)
+        extraData[name + "_P50"] = "{:.1f}".format(p50[i])
+        extraData[name + "_P95"] = "{:.1f}".format(p95[i])
+    s.saveExtraData(TIMING_FILE, extraData)
+
+    return timings
 
 def lightgraph(params, event):
     s.startModuleDebug("allsky_lightgraph")
 
+    global _drawer
     debug = params["debug"]
-    drawer = lGraph(debug, params)
-    drawer.exportData()
-    drawer.draw(params)
+    if _drawer is None:
+        _drawer = lGraph(debug, params)
+    else:
+        _drawer.update(debug, params)
+    drawer = _drawer
+    drawer._timed("EXPORT", drawer.exportData)
+    drawer._timed("DRAW", drawer.draw, params)
+
+    # the draw phase is only the rendering and blending, the calculations it runs are timed on their own
+    drawer.timings["DRAW"] = drawer.timings["DRAW"] - drawer.timings["CALC"] - drawer.timings["SUNMOON"]
+    timings = publishTimings(drawer.timings, int(params.get("timing_frames", 100)))
+    s.log(4, "INFO: Light graph timings " + ", ".join("{} {:.1f} ms".format(phase, value) for phase, value in timings.items()))
     result ="Light Graph Complete"
     
     s.log(1, "INFO {0}".format(result))
     return result
+
+def lightgraph_cleanup():
+    moduleData = {
+        "metaData": metaData,
+        "cleanup": {
+            "files": {
+                TIMING_FILE
+            },
+            "env": {}
+        }
+    }
+    s.cleanupModule(moduleData)
+    tmpPath = s.getEnvironmentVariable("ALLSKY_TMP")
+    if tmpPath is not None and os.path.exists(os.path.join(tmpPath, TIMING_HISTORY)):
+        os.remove(os.path.join(tmpPath, TIMING_HISTORY))
+
+_batch = {}
+
+def _batchParams(paramsFile, latitude, longitude):
+    # module defaults with the checkboxes as booleans, like the module manager passes them
+    params = {}
+    for name, value in metaData["arguments"].items():
+        if isinstance(value, str) and value.lower() in ("true", "false"):
+            value = value.lower() == "true"
+        params[name] = value
+
+    if paramsFile is not None:
+        with open(paramsFile, "r") as file:
+            params.update(json.load(file))
+    if latitude is not None:
+        params["latitude"] = latitude
+    if longitude is not None:
+        params["longitude"] = longitude
+
+    return params
+
+def _batchInit(params, base, blank):
+    s.image = base
+    _batch["params"] = params
+    _batch["base"] = base
+    _batch["blank"] = blank
+    _batch["drawer"] = None
+
+def _batchRender(times, output, format):
+    '''
+    Renders a run of consecutive UTC times with a single drawer, so the events and elevation
+    samples slide along instead of being rebuilt. PNG files are written here, for a NumPy stack
+    the layers are returned to the parent.
+    '''
+    params = _batch["params"]
+    results = []
+    for nowUTC in times:
+        if _batch["drawer"] is None:
+            _batch["drawer"] = lGraph(False, params, nowUTC)
+        else:
+            _batch["drawer"].update(False, params, nowUTC)
+        drawer = _batch["drawer"]
+        drawer.calculations(False, params)
+        if params["draw_elev"] == True:
+            drawer.calSunMoon(params)
+        layers = drawer.render(params)
+
+        if format == "npz":
+            results.append(layers)
+            continue
+
+        fileName = os.path.join(output, "lightgraph-{}.png".format(drawer.nowTime.strftime("%Y%m%d%H%M%S")))
+        if _batch["blank"]:
+            # a transparent frame holding only the graph, with straight alpha as PNG expects
+            frame = np.zeros(_batch["base"].shape[:2] + (4,), dtype=np.uint8)
+            for sprite, (x, y) in layers:
+                cover = sprite[:, :, 3:].astype(np.float32)
+                colors = sprite[:, :, :3] * (255.0 / np.maximum(cover, 1.0))
+                frame[y:y + sprite.shape[0], x:x + sprite.shape[1], :3] = np.clip(colors + 0.5, 0, 255).astype(np.uint8)
+                frame[y:y + sprite.shape[0], x:x + sprite.shape[1], 3] = sprite[:, :, 3]
+        else:
+            frame = _batch["base"].copy()
+            s.image = frame
+            for sprite, origin in layers:
+                _composite(sprite, origin, float(params["alpha"]))
+        cv2.imwrite(fileName, frame)
+        results.append(fileName)
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Renders light graph overlays for a range of local times")
+    parser.add_argument("start", help="First local time, i.e. '2024-01-31 18:00'")
+    parser.add_argument("finish", help="Last local time")
+    parser.add_argument("-s", "--step", type=int, default=60, help="Seconds between overlays, default 60")
+    parser.add_argument("-o", "--output", default=".", help="Folder for the overlays, default the current folder")
+    parser.add_argument("-f", "--format", choices=["png", "npz"], default="png", \
+        help="png writes one image per time, npz a single NumPy stack per graph part")
+    parser.add_argument("-b", "--base", help="Image to draw on, without it the overlays are transparent RGBA")
+    parser.add_argument("--size", default="1920x1080", help="Frame size when there is no base image, default 1920x1080")
+    parser.add_argument("-p", "--params", help="JSON file with the module parameters, defaults are used otherwise")
+    parser.add_argument("--latitude", help="Latitude i.e. 52.2N, read from the allsky settings otherwise")
+    parser.add_argument("--longitude", help="Longitude i.e. 21.0E, read from the allsky settings otherwise")
+    parser.add_argument("-j", "--processes", type=int, default=os.cpu_count(), help="Worker processes, default all cores")
+    args = parser.parse_args()
+
+    # the event tables are shared by the workers through the tmp folder
+    if s.getEnvironmentVariable("ALLSKY_TMP") is None:
+        os.environ["ALLSKY_TMP"] = tempfile.gettempdir()
+
+    params = _batchParams(args.params, args.latitude, args.longitude)
+    if args.base is not None:
+        base = cv2.imread(args.base)
+        if base is None:
+            sys.exit("Cannot read base image {}".format(args.base))
+    else:
+        width, height = (int(value) for value in args.size.split("x"))
+        base = np.zeros((height, width, 3), dtype=np.uint8)
+
+    start = datetime.datetime.fromisoformat(args.start).timestamp()
+    finish = datetime.datetime.fromisoformat(args.finish).timestamp()
+    times = [_utcDatetime(timestamp) for timestamp in np.arange(start, finish + 1, args.step)]
+    if len(times) == 0:
+        sys.exit("No times between {} and {}".format(args.start, args.finish))
+    os.makedirs(args.output, exist_ok=True)
+
+    # generate the event tables once before the workers start
+    _batchInit(params, base, args.base is None)
+    _batchRender(times[:1], args.output, "npz")
+
+    processes = max(1, min(args.processes, len(times)))
+    runLength = max(1, int(np.ceil(len(times) / (processes * 4))))
+    runs = [(times[i:i + runLength], args.output, args.format) for i in range(0, len(times), runLength)]
+    with Pool(processes, initializer=_batchInit, initargs=(params, base, args.base is None)) as pool:
+        results = [result for run in pool.starmap(_batchRender, runs) for result in run]
+
+    if args.format == "npz":
+        arrays = {"times": np.array([_timestamp(nowUTC) for nowUTC in times])}
+        for i, (sprite, origin) in enumerate(results[0]):
+            arrays["origin{}".format(i)] = np.array(origin)
+            arrays["layer{}".format(i)] = np.stack([layers[i][0] for layers in results])
+        fileName = os.path.join(args.output, "lightgraph.npz")
+        np.savez(fileName, **arrays)
+        print("Wrote {} overlays to {}".format(len(times), fileName))
+    else:
+        print("Wrote {} overlays to {}".format(len(results), args.output))
+
+if __name__ == "__main__":
+    main()
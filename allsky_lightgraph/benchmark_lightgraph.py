@@ -0,0 +1,202 @@
+'''
+benchmark_lightgraph.py
+
+Reproducible benchmark for the allsky_lightgraph module. It runs on any Linux box, allsky_shared
+is replaced by a small stub so no allsky installation is needed, only the module requirements.
+
+For every combination of image size, alpha, elevation chart, hour numbers, now point and site
+it times the lGraph construction, exportData and draw, the last one with no cached overlay
+(cold), with the overlay only in the tmp folder (file, like a new process) and with the
+overlay in memory (warm). Results are written as JSON with the per-phase timings in ms and the
+peak traced memory of each phase.
+
+    python3 benchmark_lightgraph.py -n 5 -o results.json
+    python3 benchmark_lightgraph.py --quick
+'''
+import os
+import sys
+import json
+import time
+import types
+import argparse
+import datetime
+import itertools
+import tempfile
+import tracemalloc
+import platform
+import numpy as np
+
+SIZES = {
+    "1080p": (1920, 1080),
+    "4K": (3840, 2160),
+    "6K": (6144, 4096)
+}
+
+# the high latitude sites have no night in summer and no sunrise in winter
+SITES = {
+    "mid": ("52.2N", "21.0E"),
+    "high": ("69.6N", "18.9E"),
+    "polar": ("78.2N", "15.6E")
+}
+
+DATES = {
+    "summer": "2024-06-21 22:00",
+    "winter": "2024-12-21 22:00"
+}
+
+def stubShared(tmpPath, settings):
+    shared = types.ModuleType("allsky_shared")
+    shared.image = None
+    shared.db = {}
+
+    def convertLatLon(value):
+        value = str(value).strip()
+        if value[-1].upper() in "NSEW":
+            sign = -1 if value[-1].upper() in "SW" else 1
+            return sign * float(value[:-1])
+        return float(value)
+
+    def getEnvironmentVariable(name, fatal=False, error=''):
+        if name == "ALLSKY_TMP":
+            return tmpPath
+        return os.environ.get(name)
+
+    shared.log = lambda level, message: None
+    shared.getSetting = lambda name: settings.get(name)
+    shared.convertLatLon = convertLatLon
+    shared.getEnvironmentVariable = getEnvironmentVariable
+    shared.startModuleDebug = lambda module: None
+    shared.saveExtraData = lambda fileName, extraData: None
+    shared.deleteExtraData = lambda fileName: None
+    shared.dbHasKey = lambda key: key in shared.db
+    shared.dbGet = lambda key: shared.db[key]
+    shared.dbAdd = lambda key, value: shared.db.__setitem__(key, value)
+    shared.dbUpdate = lambda key, value: shared.db.__setitem__(key, value)
+    shared.dbDeleteKey = lambda key: shared.db.pop(key, None)
+    sys.modules["allsky_shared"] = shared
+
+    return shared
+
+def measure(function):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = function()
+    elapsed = (time.perf_counter() - started) * 1000.0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, elapsed, peak
+
+def summary(values):
+    return {
+        "min": round(float(np.min(values)), 3),
+        "median": round(float(np.median(values)), 3),
+        "mean": round(float(np.mean(values)), 3),
+        "max": round(float(np.max(values)), 3)
+    }
+
+def benchmark(lg, shared, tmpPath, params, base, nowUTC, repeat):
+    phases = ["construct", "exportData", "drawCold", "drawFile", "drawWarm"]
+    times = {phase: [] for phase in phases}
+    memory = {phase: 0 for phase in phases}
+    overlayFile = os.path.join(tmpPath, lg.overlayCache.cacheFile)
+
+    for i in range(repeat):
+        lg._overlayMemory.clear()
+        if os.path.exists(overlayFile):
+            os.remove(overlayFile)
+
+        shared.image = base.copy()
+        drawer, elapsed, peak = measure(lambda: lg.lGraph(False, params, nowUTC))
+        times["construct"].append(elapsed)
+        memory["construct"] = max(memory["construct"], peak)
+
+        result, elapsed, peak = measure(drawer.exportData)
+        times["exportData"].append(elapsed)
+        memory["exportData"] = max(memory["exportData"], peak)
+
+        result, elapsed, peak = measure(lambda: drawer.draw(params))
+        times["drawCold"].append(elapsed)
+        memory["drawCold"] = max(memory["drawCold"], peak)
+
+        lg._overlayMemory.clear()
+        shared.image = base.copy()
+        result, elapsed, peak = measure(lambda: drawer.draw(params))
+        times["drawFile"].append(elapsed)
+        memory["drawFile"] = max(memory["drawFile"], peak)
+
+        shared.image = base.copy()
+        result, elapsed, peak = measure(lambda: drawer.draw(params))
+        times["drawWarm"].append(elapsed)
+        memory["drawWarm"] = max(memory["drawWarm"], peak)
+
+    return {
+        "ms": {phase: summary(times[phase]) for phase in phases},
+        "peakBytes": memory
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the allsky_lightgraph module")
+    parser.add_argument("-n", "--repeat", type=int, default=5, help="Runs per case, default 5")
+    parser.add_argument("-o", "--output", help="JSON results file, printed when not given")
+    parser.add_argument("--quick", action="store_true", help="Only 1080p at the mid latitude site")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the random base image")
+    args = parser.parse_args()
+
+    tmpPath = tempfile.mkdtemp(prefix="lightgraph-benchmark-")
+    settings = {"latitude": SITES["mid"][0], "longitude": SITES["mid"][1]}
+    shared = stubShared(tmpPath, settings)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import allsky_lightgraph as lg
+
+    defaults = {}
+    for name, value in lg.metaData["arguments"].items():
+        if isinstance(value, str) and value.lower() in ("true", "false"):
+            value = value.lower() == "true"
+        defaults[name] = value
+
+    sizes = ["1080p"] if args.quick else list(SIZES.keys())
+    sites = ["mid"] if args.quick else list(SITES.keys())
+    rng = np.random.default_rng(args.seed)
+
+    results = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "numpy": np.__version__,
+        "repeat": args.repeat,
+        "tables": {},
+        "cases": []
+    }
+
+    for size in sizes:
+        width, height = SIZES[size]
+        base = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        for site, date in itertools.product(sites, DATES.keys()):
+            settings["latitude"], settings["longitude"] = SITES[site]
+            nowUTC = datetime.datetime.fromisoformat(DATES[date])
+
+            # the yearly event table is generated once per site, time it on its own
+            shared.image = base.copy()
+            if "{}-{}".format(site, nowUTC.year) not in results["tables"]:
+                result, elapsed, peak = measure(lambda: lg.lGraph(False, defaults, nowUTC).exportData())
+                results["tables"]["{}-{}".format(site, nowUTC.year)] = {"ms": round(elapsed, 3), "peakBytes": peak}
+
+            for alpha, drawElev, hourNums, nowPoint in itertools.product((0.6, 1.0), (True, False), (True, False), ("Center", "Left")):
+                params = dict(defaults)
+                params.update({"alpha": alpha, "draw_elev": drawElev, "hour_nums": hourNums, "now_point": nowPoint})
+                case = {"size": size, "site": site, "date": date, "alpha": alpha, "draw_elev": drawElev, \
+                    "hour_nums": hourNums, "now_point": nowPoint}
+                case.update(benchmark(lg, shared, tmpPath, params, base, nowUTC, args.repeat))
+                results["cases"].append(case)
+                print("{size:>5} {site:>5} {date:>6} alpha={alpha} elev={draw_elev!s:5} nums={hour_nums!s:5} {now_point:6}".format(**case) \
+                    + " cold {:8.2f} ms  warm {:7.2f} ms".format(case["ms"]["drawCold"]["median"], case["ms"]["drawWarm"]["median"]), \
+                    file=sys.stderr)
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
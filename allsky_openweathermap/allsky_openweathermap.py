@@ -11,8 +11,8 @@ import allsky_shared as s
 import os
 import requests
 import json
-from meteocalc import heat_index
-from meteocalc import dew_point, Temp
+import math
+import numpy as np
 
 metaData = {
     "name": "Open Weather Map",
@@ -75,6 +75,61 @@ metaData = {
 
 extraData = {}
 
+def cToF(temperature):
+    return temperature * 9 / 5.0 + 32
+
+def fToC(temperature):
+    return (temperature - 32) * 5 / 9.0
+
+def cToK(temperature):
+    return temperature + 273.15
+
+def kToC(temperature):
+    return temperature - 273.15
+
+def calcDewPoint(temperature, humidity):
+    '''
+    Dew point in C from the temperature in C and the relative humidity in % (1-100), with the
+    Arden Buck constants for positive and negative temperatures as used by meteocalc. Works on
+    single values, where a humidity out of range raises a ValueError, and on NumPy arrays, where
+    it gives NaN.
+    '''
+    if isinstance(temperature, (int, float)) and isinstance(humidity, (int, float)):
+        if humidity < 1 or humidity > 100:
+            raise ValueError('Incorrect value for humidity: "{}". Correct range 1-100.'.format(humidity))
+        b, c = (17.368, 238.88) if temperature > 0 else (17.966, 247.15)
+        pa = math.log(humidity / 100.0) + b * temperature / (c + temperature)
+        return c * pa / (b - pa)
+
+    temperature = np.asarray(temperature, dtype=np.float64)
+    humidity = np.where((humidity < 1) | (humidity > 100), np.nan, np.asarray(humidity, dtype=np.float64))
+    positive = temperature > 0
+    b = np.where(positive, 17.368, 17.966)
+    c = np.where(positive, 238.88, 247.15)
+    pa = np.log(humidity / 100.0) + b * temperature / (c + temperature)
+
+    return c * pa / (b - pa)
+
+def _rothfusz(t, humidity):
+    return -42.379 + 2.04901523 * t + 10.14333127 * humidity - 0.22475541 * t * humidity \
+        - 6.83783e-3 * t * t - 5.481717e-2 * humidity * humidity + 1.22874e-3 * t * t * humidity \
+        + 8.5282e-4 * t * humidity * humidity - 1.99e-6 * t * t * humidity * humidity
+
+def calcHeatIndex(temperature, humidity):
+    '''
+    Heat index in C from the temperature in C and the relative humidity in %, the NOAA simple
+    formula below 80F and the Rothfusz regression above as used by meteocalc, for single values
+    or NumPy arrays
+    '''
+    t = cToF(temperature)
+    heatIndex = 0.5 * (t + 61.0 + (t - 68.0) * 1.2 + humidity * 0.094)
+    if isinstance(heatIndex, float):
+        if heatIndex >= 80:
+            heatIndex = _rothfusz(t, humidity)
+        return fToC(heatIndex)
+
+    return fToC(np.where(heatIndex >= 80, _rothfusz(t, humidity), heatIndex))
+
 def processResult(data, expires, units):
     #rawData = '{"coord":{"lon":0.2,"lat":52.4},"weather":[{"id":802,"main":"Clouds","description":"scattered clouds","icon":"03d"}],"base":"stations","main":{"temp":291.84,"feels_like":291.28,"temp_min":290.91,"temp_max":292.65,"pressure":1007,"humidity":58},"visibility":10000,"wind":{"speed":8.23,"deg":250,"gust":10.8},"clouds":{"all":40},"dt":1664633294,"sys":{"type":2,"id":2012440,"country":"GB","sunrise":1664603991,"sunset":1664645870},"timezone":3600,"id":2633751,"name":"Witchford","cod":200}'
     #data = json.loads(rawData)
@@ -103,19 +158,18 @@ def processResult(data, expires, units):
     temperature = float(getValue("main.temp", data))
     humidity = float(getValue("main.humidity", data))
     if units == "imperial":
-        t = Temp(temperature, 'f')
-        dewPoint = dew_point(t, humidity).f
-        heatIndex = heat_index(t, humidity).f
+        t = fToC(temperature)
+        dewPoint = cToF(calcDewPoint(t, humidity))
+        heatIndex = cToF(calcHeatIndex(t, humidity))
     
     if units == "metric":
-        t = Temp(temperature, 'c')        
-        dewPoint = dew_point(temperature, humidity).c
-        heatIndex = heat_index(temperature, humidity).c
+        dewPoint = calcDewPoint(temperature, humidity)
+        heatIndex = calcHeatIndex(temperature, humidity)
 
     if units == "standard":
-        t = Temp(temperature, 'k')        
-        dewPoint = dew_point(temperature, humidity).k
-        heatIndex = heat_index(temperature, humidity).k
+        t = kToC(temperature)
+        dewPoint = cToK(calcDewPoint(t, humidity))
+        heatIndex = cToK(calcHeatIndex(t, humidity))
         
     extraData["AS_OWDEWPOINT"] = {
         "value": round(dewPoint,1),